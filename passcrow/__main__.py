@@ -158,7 +158,7 @@ def cli_list(args):
     args = arg_dict(args, options='C:D:H:Tb', invalid_exc=UsageError)
     batch = args.get('-b', False)
     try:
-        secrets = list(make_pc(args))
+        secrets = [(p.name, p) for p in make_pc(args).list_packs()]
         if secrets:
             # Sort our output
             secrets.sort(key=lambda p: (p[1].created_ts, p[0]))
@@ -175,8 +175,9 @@ def cli_list(args):
                 print(fmt % (
                     '%4.4d-%2.2d-%2.2d' % (ct.year, ct.month, ct.day),
                     '%2.2d:%2.2d' % (ct.hour, ct.minute),
-                    '%4.4d-%2.2d-%2.2d' % (et.year, et.month, et.day),
-                    '%2.2d:%2.2d' % (et.hour, et.minute),
+                    '%4.4d-%2.2d-%2.2d' % (et.year, et.month, et.day)
+                        if et else 'never',
+                    '%2.2d:%2.2d' % (et.hour, et.minute) if et else '',
                     name))
         else:
             sys.stderr.write('*** (no passcrow data) ***\n')
@@ -212,12 +213,16 @@ def cli_protect(args):
         -n <NAME>     Description in passcrow database (required for stdin)
         -e            Ephemeral: local storage optional, small secrets only
         -E            Ephemeral only: skip local storage, small secrets only
+        -j            Queue the escrow requests as a job for `passcrow worker`
+
+    Note that a queued job holds all that is needed to recover the secret,
+    until the worker has finished escrowing it.
     """
     # FIXME: -q       Quick operation (reduced anonymity)
     # FIXME: -f = force, otherwise refuse to clobber existing secrets?
 
     args = arg_dict(args,
-        options='C:D:H:TIp:r:d:m:beEn:q',
+        options='C:D:H:TIp:r:d:m:beEjn:q',
         multi='np',
         bare_args=True,
         invalid_exc=UsageError)
@@ -231,6 +236,7 @@ def cli_protect(args):
 
     quick = args.get('-q', False) or True  # FIXME
     batch = args.get('-b', False)
+    background = args.get('-j', False)
     source = args['_'].pop(0)
     try:
         name = ' '.join(args['-n'])
@@ -252,7 +258,15 @@ def cli_protect(args):
         raise UsageError(e)
 
     try:
-        result = pc.protect(name, data, pol, quick=quick, ephemeral=ephemeral)
+        result = pc.protect(name, data, pol, quick=quick, ephemeral=ephemeral,
+            background=background)
+        if background:
+            if batch:
+                print('%s' % result)
+            else:
+                print('Queued as job %s, run `passcrow worker` to finish.'
+                    % result)
+            return True
         if ephemeral and result:
             if batch:
                 print('%s' % result)
@@ -418,13 +432,15 @@ def cli_forget(args):
 
     Options:
         -l            Local only (do not contact remote servers)
+        -j            Queue remote deletion as a job for `passcrow worker`
     """
-    args = arg_dict(args, options='C:D:H:Tlq', bare_args=True,
+    args = arg_dict(args, options='C:D:H:Tljq', bare_args=True,
                           invalid_exc=UsageError)
 
     names = args['_']
     quick = args.get('-q', False) or True  # FIXME
     noremote = args.get('-l', False)
+    background = args.get('-j', False) and not noremote
     pc = make_pc(args)
 
     # FIXME: Add support for ephemeral forgetfulness? Do we want to be
@@ -434,14 +450,185 @@ def cli_forget(args):
     failed = []
     for name in names:
         try:
-            if not pc.delete(name, remote=(not noremote), quick=quick):
+            result = pc.delete(name,
+                remote=(not noremote), quick=quick, background=background)
+            if not result:
                 raise ValueError('delete failed')
+            if background:
+                print('Queued deletion of %s as job %s' % (name, result))
         except (ValueError, OSError) as e:
             sys.stderr.write('Failed(%s): %s\n' % (name, e))
             failed.append(name)
     return (not failed)
 
 
+def cli_renew(args):
+    """[<SECRET_NAMES>] [<POLICY options>]
+
+    Renew secrets whose escrow will soon expire. Escrow cannot be
+    extended, so the secrets are protected anew and the old escrow is
+    deleted afterwards. This requires access to the secret data: a secret
+    protected from a file (`passcrow protect secrets.txt`) is re-read from
+    that same file, others need -i. The current default policy is used,
+    unless policy options are given.
+
+    Without names, all secrets expiring within the renewal window are
+    renewed.
+
+    Examples:
+        passcrow renew -l        # List secrets which need renewal
+        passcrow renew -w 60     # Renew everything expiring within 60 days
+
+        cat secrets.txt | passcrow renew -i - "My Secret Data"
+
+    Options:
+        -w <DAYS>     Renew secrets expiring within DAYS days (default 30)
+        -i <PATH|->   Read the data for a single named secret from here
+        -l            List secrets due for renewal and exit
+        -j            Queue deletion of old escrow for `passcrow worker`
+    """
+    from .client import DEFAULT_RENEW_DAYS
+    args = arg_dict(args,
+        options='C:D:H:TIp:r:d:m:w:i:ljq',
+        multi='p',
+        bare_args=True,
+        invalid_exc=UsageError)
+
+    quick = args.get('-q', False) or True  # FIXME
+    days = int(args.get('-w', [DEFAULT_RENEW_DAYS])[0])
+    source = args.get('-i', [None])[0]
+    names, args['_'] = args['_'], []
+    if source and len(names) != 1:
+        raise UsageError('Please name exactly one secret to renew with -i.')
+
+    pc = make_pc(args)
+    if not names:
+        names = [info.name for info in pc.expiring_packs(days)]
+    if args.get('-l'):
+        by_name = dict((info.name, info) for info in pc.list_packs())
+        for name in names:
+            if name in by_name:
+                e = by_name[name].expires
+                if e is None:
+                    print('%-16s  %s' % ('never', name))
+                else:
+                    print('%4.4d-%2.2d-%2.2d %2.2d:%2.2d  %s' % (
+                        e.year, e.month, e.day, e.hour, e.minute, name))
+        return True
+    if not names:
+        sys.stderr.write('Nothing needs renewal.\n')
+        return True
+
+    pol = make_policy(args, pc)
+    failed = []
+    def items():
+        for name in names:
+            try:
+                if source == '-':
+                    yield name, sys.stdin.buffer.read()
+                else:
+                    with open(source or name, 'rb') as fd:
+                        yield name, fd.read()
+            except (IOError, OSError) as e:
+                sys.stderr.write('Cannot renew %s: %s\n' % (name, e))
+                failed.append(name)
+
+    results = pc.renew_many(items(), pol,
+        quick=quick, background=args.get('-j', False))
+    for name, result in results.items():
+        if result is not True:
+            sys.stderr.write('Failed renew(%s): %s\n' % (name, result))
+            failed.append(name)
+    sys.stderr.write('Renewed %d secrets.\n'
+        % len([r for r in results.values() if r is True]))
+    return (not failed)
+
+
+def cli_vouchers(args):
+    """[<PATH|->]
+
+    Add prepaid vouchers to your wallet, or list how many you have. The
+    vouchers are read from a file (or standard input), one per line, in
+    the format generated by passcrow servers:
+
+        <SCHEME_ID> <VOUCHER>
+
+    Vouchers are used instead of hashcash when protecting secrets on a
+    server which accepts them, and are only removed from the wallet once
+    the server has accepted them.
+
+    Examples:
+        passcrow vouchers vouchers.txt
+        passcrow vouchers -l
+
+    Options:
+        -l            List the vouchers in the wallet (counts only)
+    """
+    args = arg_dict(args, options='C:D:H:Tl', bare_args=True,
+                          invalid_exc=UsageError)
+    pc = make_pc(args)
+    if args.get('-l') or not args['_']:
+        for scheme_id, count in sorted(pc.voucher_counts().items()):
+            print('%-24s %d' % (scheme_id, count))
+        return True
+
+    source = args['_'][0]
+    try:
+        fd = sys.stdin if (source == '-') else open(source, 'r')
+        vouchers = {}
+        for line in fd:
+            line = line.strip()
+            if line and line[:1] != '#':
+                scheme_id, voucher = line.split()
+                vouchers.setdefault(scheme_id, []).append(voucher)
+    except (IOError, OSError) as e:
+        raise UsageError(e)
+    except ValueError:
+        raise UsageError('Invalid voucher line: %s' % line)
+
+    for scheme_id, vlist in vouchers.items():
+        pc.add_vouchers(scheme_id, vlist)
+        sys.stderr.write('Added %d vouchers for %s\n' % (len(vlist), scheme_id))
+    return True
+
+
+def cli_worker(args):
+    """[...]
+
+    Carry out queued escrow jobs (see `passcrow protect -j` and `passcrow
+    forget -j`), sleeping a random while between requests so servers
+    cannot easily correlate them. Progress is saved as it is made, so the
+    worker can safely be stopped and restarted later.
+
+    Options:
+        -l            List queued jobs and exit
+        -n <N>        Stop after attempting N tasks
+    """
+    args = arg_dict(args, options='C:D:H:Tln:q', invalid_exc=UsageError)
+    quick = args.get('-q', False)
+    max_tasks = int(args.get('-n', [0])[0]) or None
+    pc = make_pc(args)
+
+    if args.get('-l'):
+        for job in pc.list_jobs():
+            print('%s %-7s %3d tasks%s  %s' % (
+                job.id, job.kind, len(job.tasks),
+                ' (FAILED)' if job.failed else '',
+                job.name))
+            if 'last-error' in job:
+                print('    %s' % job.last_error)
+        return True
+
+    try:
+        done = pc.run_jobs(quick=quick, max_tasks=max_tasks)
+    except (IOError, OSError) as e:
+        raise UsageError(e)
+    remaining = pc.list_jobs()
+    sys.stderr.write('Completed %d tasks, %d jobs remaining.\n'
+        % (done, len(remaining)))
+    return not any(job.failed for job in remaining)
+
+
 def cli_server_init(args):
     """[<USER> [<CONFIG_FILE> [<DATA_DIRECTORY>]]]
 
@@ -503,7 +690,7 @@ def cli_help(args, error=None):
         p('passcrow %s %s' % (args[0], cmd.__doc__.rstrip()))
         if cmd == cli_init:
             p(make_pc.__doc__.rstrip())
-        if cmd == cli_protect:
+        if cmd in (cli_protect, cli_renew):
             from .client import PasscrowIdentityPolicy
             p(make_policy.__doc__.rstrip())
             p(PasscrowIdentityPolicy.__doc__.rstrip())
@@ -542,6 +729,9 @@ CLI_COMMANDS.update({
     'protect': cli_protect,
     'recover': cli_recover,
     'forget': cli_forget,
+    'renew': cli_renew,
+    'vouchers': cli_vouchers,
+    'worker': cli_worker,
     'help': cli_help})
 
 
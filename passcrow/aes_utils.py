@@ -3,7 +3,9 @@ import struct
 import time
 
 import cryptography.hazmat.backends
+from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF, HKDFExpand
 from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 
 
@@ -27,7 +29,56 @@ def derive_aesgcm_key(*key, salt=b'', n_factor=20, length=256):
     return kdf.derive(b''.join(key))
 
 
-def random_aesgcm_key(length=256, insecure=False):
+def expand_aesgcm_key(key, info, length=256):
+    """
+    Expand a strong (e.g. already scrypt-derived) key into a distinct
+    subkey for the purpose named by `info`. This is cheap.
+    """
+    assert(length in (128, 192, 256))
+    return HKDFExpand(
+        algorithm=hashes.SHA256(),
+        length=(length//8),
+        info=info,
+        backend=cryptography.hazmat.backends.default_backend()
+        ).derive(key)
+
+
+_RNG_CHECKED = False
+
+def check_rng(samples=4, sample_bytes=64):
+    """
+    Sanity check the OS random number generator, raising an OSError if
+    it is obviously broken (repeating itself, or returning runs of the
+    same few byte values). This cannot prove the RNG is any good, but it
+    catches the catastrophic failures. Only runs once per process.
+    """
+    global _RNG_CHECKED
+    if _RNG_CHECKED:
+        return True
+    seen = set()
+    for i in range(0, samples):
+        sample = random_bytes(sample_bytes)
+        if sample in seen or len(set(sample)) < sample_bytes // 4:
+            raise OSError('The OS random number generator looks broken!')
+        seen.add(sample)
+    _RNG_CHECKED = True
+    return True
+
+
+def _hkdf_aesgcm_key(length, insecure):
+    # Expanding urandom output with HKDF is cheap; mixing in the time and
+    # PID guards against the RNG state being duplicated (e.g. by fork).
+    check_rng()
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=(length//8),
+        salt=None,
+        info=b'Passcrow key:%d:%s' % (os.getpid(), bytes(str(time.time()), 'latin-1')),
+        backend=cryptography.hazmat.backends.default_backend()
+        ).derive(random_bytes(length // 4))
+
+
+def _scrypt_aesgcm_key(length, insecure):
     # Stretching with the time and PID are a weak defense, in case the OS
     # is giving us very lame random data. We use a lower n_factor to save
     # cycles. The "insecure" mode is for generating keys which are only used
@@ -40,21 +91,37 @@ def random_aesgcm_key(length=256, insecure=False):
         length=length)
 
 
+# Key generation strategies; the scrypt stretching is much slower, and
+# only worth it if the OS RNG is suspect. Select with set_key_generator()
+# or the PASSCROW_KEYGEN environment variable.
+KEY_GENERATORS = {
+    'hkdf': _hkdf_aesgcm_key,
+    'scrypt': _scrypt_aesgcm_key}
+
+DEFAULT_KEY_GENERATOR = os.getenv('PASSCROW_KEYGEN', 'hkdf')
+
+
+def set_key_generator(name):
+    global DEFAULT_KEY_GENERATOR
+    if name not in KEY_GENERATORS:
+        raise KeyError('Unknown key generator: %s' % name)
+    DEFAULT_KEY_GENERATOR = name
+
+
+def random_aesgcm_key(length=256, insecure=False, method=None):
+    return KEY_GENERATORS[method or DEFAULT_KEY_GENERATOR](length, insecure)
+
+
 def aesgcm_key_to_int(bin_key):
-    int_key = 0
-    for b in bin_key:
-        int_key *= 256
-        int_key += b
-    return int_key
+    return int.from_bytes(bin_key, 'big')
 
-def aesgcm_key_from_int(int_key):
-    bin_key = bytearray()
-    while int_key:
-        bin_key.append(int_key % 256)
-        int_key //= 256
-    return bytes(reversed(bin_key))
+def aesgcm_key_from_int(int_key, length=None):
+    # Note: Without a length, leading zero bytes are dropped.
+    return int_key.to_bytes(length or ((int_key.bit_length() + 7) // 8), 'big')
 
 
+# Note: AES contexts are deliberately not cached; a long-running server
+#       would otherwise keep recent users' escrow keys around in RAM.
 def aesgcm_encrypt(key, nonce, data, aad=DEFAULT_ASSOC_DATA):
     return AESGCM(key).encrypt(nonce, data, aad)
 
@@ -75,9 +142,16 @@ if __name__ == "__main__":
     ct1 = aesgcm_encrypt(bogus_key, bogus_nonce, hello)
 
     assert(bogus_key == aesgcm_key_from_int(aesgcm_key_to_int(bogus_key)))
+    assert(aesgcm_key_from_int(aesgcm_key_to_int(b'\0\1'), 2) == b'\0\1')
+    assert(aesgcm_key_from_int(aesgcm_key_to_int(b'\0\1')) == b'\1')
 
     assert(ct1 != hello)  # lol
     assert(len(random_aesgcm_key(insecure=True)) == len(bogus_key))
+    for method in KEY_GENERATORS:
+        for length in (128, 192, 256):
+            k1 = random_aesgcm_key(length=length, method=method, insecure=True)
+            k2 = random_aesgcm_key(length=length, method=method, insecure=True)
+            assert(len(k1) == length // 8 and k1 != k2)
     assert(aesgcm_decrypt(bogus_key, bogus_nonce, ct1) == hello)
 
     print("ok")
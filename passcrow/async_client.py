@@ -0,0 +1,254 @@
+"""Passcrow asyncio client
+
+AsyncPasscrowClient offers awaitable versions of protect(), verify(),
+recover(), delete() and renew(), for use within asyncio applications:
+
+    client = AsyncPasscrowClient()
+    secret = await client.recover(client.pack('Secret 1'), codes)
+
+The requests and responses are built and processed by exactly the same
+code as in the synchronous PasscrowClient (its operations are written
+as generators which yield the steps requiring network I/O); only the
+steps themselves are implemented differently here. HTTP requests use
+asyncio streams (see transport.AsyncHTTPSPool) and sleeps do not block
+the event loop. CPU-heavy preparations, such as minting hashcash, are
+run in a thread pool.
+
+Operations can be cancelled like any other asyncio task. Note that a
+cancelled protect() may already have escrowed some of its shares; as
+with any failed protect(), those will be orphaned until they expire.
+
+Methods not listed above (job queue, bulk operations, etc.) are
+inherited from PasscrowClient unchanged and remain synchronous.
+"""
+import asyncio
+import functools
+import random
+import time
+
+from .client import *
+from .transport import AsyncHTTPSPool
+
+
+def _async_op(op):
+    @functools.wraps(op)
+    async def run(self, *args, **kwargs):
+        return await self._run_steps(op.steps(self, *args, **kwargs))
+    return run
+
+
+class AsyncPasscrowClient(PasscrowClient):
+    def __init__(self, *args,
+            async_urlopen_func=None,
+            async_sleep_func=None,
+            **kwargs):
+        super().__init__(*args, **kwargs)
+        self.async_urlopen = async_urlopen_func or AsyncHTTPSPool()
+        self.async_sleep = async_sleep_func or asyncio.sleep
+
+    protect = _async_op(PasscrowClient.protect)
+    renew = _async_op(PasscrowClient.renew)
+    delete = _async_op(PasscrowClient.delete)
+    verify = _async_op(PasscrowClient.verify)
+    recover = _async_op(PasscrowClient.recover)
+
+    async def aclose(self):
+        if hasattr(self.async_urlopen, 'close'):
+            self.async_urlopen.close()
+
+    async def _run_steps(self, steps):
+        result = None
+        try:
+            while True:
+                try:
+                    method, args, kwargs = steps.send(result)
+                except StopIteration as e:
+                    return e.value
+                result = await getattr(self, method + '_async')(
+                    *args, **kwargs)
+        finally:
+            steps.close()
+
+    async def _in_thread(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            None, func, *args)
+
+    async def _get_server_policy_async(self, server):
+        po, cached = self._cached_server_policy(server)
+        if po is None:
+            url, data, headers = self._policy_request(server, cached)
+            resp = await self.async_urlopen(url, data=data, headers=headers)
+            po = self._remember_server_policy(
+                server, *self._parse_policy_response(resp, cached))
+            self._last_request[server] = time.time()
+            await self.async_sleep(1.5)  # Play nice with rate limits
+        return po
+
+    async def _prefetch_server_policies_async(self, idps, expiration):
+        servers = self._policy_servers(idps)
+        if not servers:
+            return
+        limit = asyncio.Semaphore(self.parallelism)
+        async def fetch(server):
+            async with limit:
+                return await self._get_server_policy_async(server)
+        policies = dict(zip(servers,
+            await asyncio.gather(*[fetch(s) for s in servers])))
+        # Checking may choose payment schemes, which uses cached policies
+        self._check_server_policies(idps, expiration, policies)
+
+    async def _rpc_async(self, server, request):
+        if self.wire_format == 'cbor':
+            # Make sure _encode_rpc will not need to fetch the policy
+            await self._get_server_policy_async(server)
+        url, data, headers, decode = self._encode_rpc(server, request)
+        resp = await self.async_urlopen(url, data=data, headers=headers)
+        return decode(resp.read())
+
+    async def _run_rpc_task_async(self, task, prepared, post, fmt_fail):
+        server, req, extras = prepared
+        try:
+            t0 = time.time()
+            resp = await self._rpc_async(server, req)
+            self._rpc_task_done(task, prepared, post, resp, time.time() - t0)
+            self._settle_payment(req, True)
+            return None
+        except asyncio.CancelledError:
+            self._settle_payment(req, False)
+            raise
+        except Exception as e:
+            self._rpc_task_failed(req, e)
+            return fmt_fail(task, server, req, extras, e)
+
+    async def _prep_later_async(self, prep, task, sleeptime, delay):
+        await self.async_sleep(delay)
+        t0 = time.time()
+        prepared = await self._in_thread(prep, task, sleeptime)
+        return prepared, t0, time.time()
+
+    async def _rpc_task_loop_async(self, tasks, prep, post, fmt_fail,
+            failures, quick, pipeline=False, mode=None, quorum=None, spare=0):
+        """
+        This behaves like PasscrowClient._rpc_task_loop, but without
+        blocking the event loop.
+        """
+        mode = self._check_rpc_mode(mode or self.rpc_mode)
+        if mode != RPC_SERIAL:
+            return await self._rpc_task_fanout_async(tasks, prep, post,
+                fmt_fail, failures, quick,
+                jitter=(mode == RPC_JITTERED), quorum=quorum, spare=spare)
+
+        sleeptime = 0
+        max_tries = len(tasks) + 3
+        prep_time = 0
+        successes = 0
+        ahead = None
+        try:
+            while tasks and len(failures) < max_tries:
+                if quorum and successes >= quorum:
+                    break
+                await self.async_sleep(sleeptime)
+                task = tasks.pop(0)
+                prepared = None
+                if ahead is not None and ahead[0] is task:
+                    prepared, t0, t1 = await ahead[1]
+                    prep_time = t1 - t0
+                    if time.time() - t1 > PIPELINE_MAX_AGE:
+                        self._settle_payment(prepared[1], False)
+                        prepared = None
+                ahead = None
+                if prepared is None:
+                    t0 = time.time()
+                    prepared = await self._in_thread(prep, task, sleeptime)
+                    prep_time = time.time() - t0
+
+                sleeptime = random.randint(self.sleep_min, self.sleep_max)
+                if quick:
+                    sleeptime = 1
+                if pipeline and tasks and not (
+                        quorum and successes + 1 >= quorum):
+                    lead = min(1 + 1.5 * prep_time, PIPELINE_MAX_AGE / 2)
+                    ahead = (tasks[0], asyncio.ensure_future(
+                        self._prep_later_async(prep, tasks[0], sleeptime,
+                            max(0, sleeptime - lead))))
+
+                failure = await self._run_rpc_task_async(
+                    task, prepared, post, fmt_fail)
+                if failure:
+                    failures.append(failure)
+                    tasks.append(task)
+                    self.log(failure)
+                else:
+                    successes += 1
+        finally:
+            if ahead is not None and not ahead[1].cancel():
+                self._discard_prepared(ahead[1])
+        if quorum:
+            return (successes >= quorum)
+        return (not tasks)
+
+    async def _rpc_task_fanout_async(self, tasks, prep, post, fmt_fail,
+            failures, quick, jitter=False, quorum=None, spare=0):
+        max_tries = len(tasks) + 3
+        jitter_max = 0
+        if jitter:
+            jitter_max = 1 if quick else min(self.sleep_max, DEFAULT_JITTER_MAX)
+
+        # Once we have reached our quorum, late results are discarded.
+        finished = []
+        def quorum_post(*args):
+            if not finished:
+                post(*args)
+
+        # One request at a time per server, see SERVER_REQUEST_INTERVAL
+        gates = {}
+        async def run(task):
+            delay = random.uniform(0, jitter_max) if jitter_max else 0
+            await self.async_sleep(delay)
+            prepared = await self._in_thread(prep, task, delay)
+            gate = gates.setdefault(prepared[0], asyncio.Lock())
+            try:
+                async with gate:
+                    if finished:
+                        self._settle_payment(prepared[1], False)
+                        return None
+                    await asyncio.sleep(self._request_wait(prepared[0]))
+                    try:
+                        return await self._run_rpc_task_async(
+                            task, prepared, quorum_post, fmt_fail)
+                    finally:
+                        self._last_request[prepared[0]] = time.time()
+            except asyncio.CancelledError:
+                self._settle_payment(prepared[1], False)
+                raise
+
+        running = {}
+        successes = 0
+        try:
+            while (tasks or running) and len(failures) < max_tries:
+                if quorum and successes >= quorum:
+                    break
+                limit = self.parallelism
+                if quorum:
+                    limit = min(limit, quorum + spare - successes)
+                while tasks and len(running) < limit:
+                    task = tasks.pop(0)
+                    running[asyncio.ensure_future(run(task))] = task
+                done, _ = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED)
+                for fut in done:
+                    task = running.pop(fut)
+                    failure = fut.result()
+                    if failure:
+                        failures.append(failure)
+                        tasks.append(task)
+                        self.log(failure)
+                    else:
+                        successes += 1
+        finally:
+            finished.append(True)
+            for fut in running:
+                fut.cancel()
+        if quorum:
+            return (successes >= quorum)
+        return (not tasks)
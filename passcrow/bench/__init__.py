@@ -0,0 +1,34 @@
+"""Passcrow microbenchmarks
+
+Each module in this package benchmarks one aspect of Passcrow and can be
+run directly, for example:
+
+    $ python3 -m passcrow.bench.json_wire
+
+Results are printed as operations per second; they are only meaningful
+when compared with each other on the same machine.
+"""
+import time
+
+
+def ops_per_second(func, seconds=1.0):
+    """Call func() repeatedly for roughly `seconds`, return calls/second."""
+    count, batch = 0, 1
+    t0 = time.perf_counter()
+    deadline = t0 + seconds
+    while True:
+        for i in range(0, batch):
+            func()
+        count += batch
+        now = time.perf_counter()
+        if now >= deadline:
+            return count / (now - t0)
+        batch = min(batch * 2, 1000)
+
+
+def report(name, rate, baseline=None):
+    if baseline:
+        print('%-40s %12.1f ops/s  (x%.2f)' % (name, rate, rate / baseline))
+    else:
+        print('%-40s %12.1f ops/s' % (name, rate))
+    return rate
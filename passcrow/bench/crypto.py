@@ -0,0 +1,75 @@
+"""Benchmark: AES-GCM and key conversion primitives."""
+import base64
+import json
+
+from ..aes_utils import AESGCM, DEFAULT_ASSOC_DATA, random_bytes
+from ..aes_utils import aesgcm_encrypt, aesgcm_decrypt
+from ..aes_utils import aesgcm_key_to_int, aesgcm_key_from_int
+from ..proto import EscrowRequestData
+from . import ops_per_second, report
+
+
+def legacy_key_to_int(bin_key):
+    int_key = 0
+    for b in bin_key:
+        int_key *= 256
+        int_key += b
+    return int_key
+
+
+def legacy_key_from_int(int_key):
+    bin_key = bytearray()
+    while int_key:
+        bin_key.append(int_key % 256)
+        int_key //= 256
+    return bytes(reversed(bin_key))
+
+
+def legacy_decrypt(obj, key):
+    ed = base64.b64decode(obj.encrypted_data)
+    ed = AESGCM(key).decrypt(ed[:16], ed[16:], DEFAULT_ASSOC_DATA)
+    return json.loads(ed)
+
+
+def main():
+    key = random_bytes(32)
+    nonce = random_bytes(16)
+    data = random_bytes(256)
+    ct = aesgcm_encrypt(key, nonce, data)
+
+    print('AES-GCM, %d byte messages:' % len(data))
+    report('  encrypt',
+        ops_per_second(lambda: aesgcm_encrypt(key, nonce, data)))
+    report('  decrypt',
+        ops_per_second(lambda: aesgcm_decrypt(key, nonce, ct)))
+
+    erd = EscrowRequestData().update({
+        'description': 'Benchmark wallet',
+        'secret': str(base64.b64encode(random_bytes(48)), 'latin-1'),
+        'timeout': 1800})
+    erd.encrypt(key)
+    blob = erd.encrypted_data
+
+    def new_decrypt():
+        erd.encrypted_data = blob
+        erd.decrypt(key)
+
+    print('EscrowRequestData (%d bytes encrypted):' % len(blob))
+    base = report('  decrypt (legacy)',
+        ops_per_second(lambda: legacy_decrypt(erd, key)))
+    report('  decrypt (current)', ops_per_second(new_decrypt), base)
+
+    int_key = aesgcm_key_to_int(key)
+    print('Key <-> integer conversion:')
+    base = report('  to_int (legacy loop)',
+        ops_per_second(lambda: legacy_key_to_int(key)))
+    report('  to_int (int.from_bytes)',
+        ops_per_second(lambda: aesgcm_key_to_int(key)), base)
+    base = report('  from_int (legacy loop)',
+        ops_per_second(lambda: legacy_key_from_int(int_key)))
+    report('  from_int (int.to_bytes)',
+        ops_per_second(lambda: aesgcm_key_from_int(int_key)), base)
+
+
+if __name__ == '__main__':
+    main()
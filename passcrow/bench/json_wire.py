@@ -0,0 +1,48 @@
+"""Benchmark: human readable vs. compact JSON serialization of responses."""
+import json
+
+from ..proto import PolicyObject, PaymentScheme, EscrowResponse
+from . import ops_per_second, report
+
+
+def make_policy():
+    po = PolicyObject()
+    po.country_code = 'IS'
+    po.about_url = 'https://passcrow.example.org/'
+    po.kinds = ['email', 'mailto', 'sms', 'tel']
+    po.max_request_bytes = 4096
+    po.max_expiration_seconds = 10 * 366 * 24 * 3600
+    po.max_timeout_seconds = 1800
+    schemes = []
+    for bits in (11, 12, 13, 14, 15):
+        ps = PaymentScheme()
+        ps.scheme = 'hashcash'
+        ps.scheme_id = 'hashcash-%d' % bits
+        ps.description = '%d-bit scrypt collisions' % bits
+        ps.expiration_seconds = 2**(bits-11) * 183 * 24 * 3600
+        ps.hashcash_bits = bits
+        schemes.append(ps)
+    po.payment_schemes = schemes
+    return po
+
+
+def main():
+    po = make_policy()
+    er = EscrowResponse().update(
+        escrow_data_id='6ad6a117-12d3daee35efa80697ad225f961148de',
+        expiration=1792364520)
+
+    for name, obj in (('PolicyObject', po), ('EscrowResponse', er)):
+        print('%s: %d bytes indented, %d bytes compact' % (
+            name, len(bytes(str(obj), 'utf-8')), len(bytes(obj))))
+        base = report('  bytes(str(obj)) (indented)',
+            ops_per_second(lambda: bytes(str(obj), 'utf-8')))
+        report('  bytes(obj) (compact)',
+            ops_per_second(lambda: bytes(obj)), base)
+        frozen = type(obj)(json.loads(bytes(obj))).freeze()
+        report('  bytes(obj) (frozen)',
+            ops_per_second(lambda: bytes(frozen)), base)
+
+
+if __name__ == '__main__':
+    main()
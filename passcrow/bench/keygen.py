@@ -0,0 +1,15 @@
+"""Benchmark: random key generation strategies, in keys per second."""
+from ..aes_utils import KEY_GENERATORS, random_aesgcm_key
+from . import ops_per_second, report
+
+
+def main():
+    base = None
+    for method in sorted(KEY_GENERATORS, key=lambda m: m != 'scrypt'):
+        rate = report('random_aesgcm_key(method=%r)' % method,
+            ops_per_second(lambda: random_aesgcm_key(method=method)), base)
+        base = base or rate
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Benchmark: protocol record parsing and serialization on the server path.
+
+For comparison, this includes a minimal copy of the original dict-backed
+_json_object implementation (with per-field lambda properties).
+"""
+import json
+
+from ..proto import EscrowRequest, VerificationRequest, EscrowResponse
+from ..proto import PASSCROW_PROTO_VERSION
+from ..util import _json_list, _json_encoder
+from . import ops_per_second, report
+
+
+class _legacy_json_object():
+    _KEYS = {}
+
+    def __init__(self, *others):
+        self._dict = {}
+        self.items = self._dict.items
+        for o in others:
+            for k, v in o.items():
+                self._setitem(k.replace('_', '-'), v)
+
+    def _setitem(self, key, value):
+        if key not in self._KEYS:
+            raise KeyError("Invalid key: %s" % key)
+        self._dict[key] = self._KEYS[key](value)
+
+    def __bytes__(self):
+        return bytes(json.dumps(self._dict,
+            separators=(',', ':'), cls=_json_encoder), 'utf-8')
+
+
+def _legacy_prop(name):
+    return (lambda s: s._dict[name], lambda s,v: s._setitem(name, v))
+
+
+class LegacyVerificationRequest(_legacy_json_object):
+    _KEYS = VerificationRequest._KEYS
+    escrow_data_id = property(*_legacy_prop('escrow-data-id'))
+    escrow_data_key = property(*_legacy_prop('escrow-data-key'))
+
+
+class LegacyEscrowRequest(_legacy_json_object):
+    _KEYS = {
+        "passcrow-escrow-request": str,
+        "parameters-key": str,
+        "parameters": str,
+        "escrow-data": _json_list(str)}
+    parameters_key = property(*_legacy_prop('parameters-key'))
+    escrow_data = property(*_legacy_prop('escrow-data'))
+
+
+class LegacyEscrowResponse(_legacy_json_object):
+    _KEYS = EscrowResponse._KEYS
+
+
+def main():
+    vreq = {
+        'passcrow-verification-request': PASSCROW_PROTO_VERSION,
+        'escrow-data-id': '6ad6a21e-6ba5900796165f7a2496d32bf8fc1178',
+        'escrow-data-key': 'yCvR9Obg3O5yZzx4fOVMKqF/2njPNR1plLvXOlqc4zY=',
+        'language': 'en',
+        'prefix': '1'}
+    ereq = {
+        'passcrow-escrow-request': PASSCROW_PROTO_VERSION,
+        'parameters-key': 'yCvR9Obg3O5yZzx4fOVMKqF/2njPNR1plLvXOlqc4zY=',
+        'parameters': 'm2yVkMbUMHGEfqUQKMvsHDk+a9TPdMqb2pxqU' * 4,
+        'escrow-data': ['6dUH2n9E6he73KDBE811V2shMI8LCUuZ4GdBUTX' * 10]}
+    eresp = {
+        'passcrow-escrow-response': PASSCROW_PROTO_VERSION,
+        'escrow-data-id': '6ad6a21e-6ba5900796165f7a2496d32bf8fc1178',
+        'expiration': 1792364520}
+
+    def parse(cls, data, attrs):
+        def _parse():
+            obj = cls(data)
+            for a in attrs:
+                getattr(obj, a)
+        return _parse
+
+    print('Parse request and read fields:')
+    base = report('  legacy VerificationRequest', ops_per_second(
+        parse(LegacyVerificationRequest, vreq,
+            ('escrow_data_id', 'escrow_data_key'))))
+    report('  VerificationRequest.from_json', ops_per_second(
+        parse(VerificationRequest.from_json, vreq,
+            ('escrow_data_id', 'escrow_data_key'))), base)
+
+    base = report('  legacy EscrowRequest', ops_per_second(
+        parse(LegacyEscrowRequest, ereq, ('parameters_key', 'escrow_data'))))
+    report('  EscrowRequest.from_json', ops_per_second(
+        parse(EscrowRequest.from_json, ereq,
+            ('parameters_key', 'escrow_data'))), base)
+
+    print('Build and serialize response:')
+    legacy = LegacyEscrowResponse(eresp)
+    base = report('  legacy EscrowResponse',
+        ops_per_second(lambda: bytes(LegacyEscrowResponse(eresp))))
+    report('  EscrowResponse',
+        ops_per_second(lambda: bytes(EscrowResponse.from_json(eresp))), base)
+    assert(json.loads(bytes(legacy)) ==
+        json.loads(bytes(EscrowResponse.from_json(eresp))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+"""Passcrow binary wire format
+
+This is a minimal CBOR (RFC 8949) encoder and decoder, supporting just
+what the Passcrow protocol needs: integers, floats, booleans, null, byte
+and text strings, arrays and maps with text keys.
+
+Most of the bulk of a Passcrow request is base64 encoded ciphertext.
+When encoding, any long text string which is canonical base64 is sent
+as a raw byte string, wrapped in tag 22 ("expected conversion to
+base64"). The decoder converts these back to the identical base64 text,
+so protocol objects are unchanged, but about 25% fewer bytes go over
+the wire.
+
+Servers advertise support by listing PASSCROW_CBOR_VERSION in the
+`passcrow-versions` of their PolicyObject; clients then select the
+format per request using the CONTENT_TYPE below. JSON is the default.
+"""
+import base64
+import binascii
+import struct
+
+
+CONTENT_TYPE = 'application/cbor'
+
+MIN_BASE64_LEN = 16
+MAX_DEPTH = 16
+
+_TAG_BASE64 = 22
+
+
+def _head(major, n):
+    major <<= 5
+    if n < 24:
+        return bytes([major | n])
+    elif n < 0x100:
+        return bytes([major | 24, n])
+    elif n < 0x10000:
+        return bytes([major | 25]) + struct.pack('>H', n)
+    elif n < 0x100000000:
+        return bytes([major | 26]) + struct.pack('>I', n)
+    elif n < 0x10000000000000000:
+        return bytes([major | 27]) + struct.pack('>Q', n)
+    raise ValueError('Integer too large')
+
+
+def _as_base64(text):
+    if len(text) < MIN_BASE64_LEN or len(text) % 4:
+        return None
+    try:
+        raw = base64.b64decode(text, validate=True)
+        if str(base64.b64encode(raw), 'latin-1') == text:
+            return raw
+    except (binascii.Error, ValueError):
+        pass
+    return None
+
+
+def _encode(obj, out):
+    if hasattr(obj, 'to_json'):
+        obj = obj.to_json()
+    if obj is None:
+        out.append(b'\xf6')
+    elif obj is True:
+        out.append(b'\xf5')
+    elif obj is False:
+        out.append(b'\xf4')
+    elif isinstance(obj, int):
+        out.append(_head(0, obj) if (obj >= 0) else _head(1, -1 - obj))
+    elif isinstance(obj, float):
+        out.append(b'\xfb' + struct.pack('>d', obj))
+    elif isinstance(obj, (bytes, bytearray)):
+        out.append(_head(2, len(obj)))
+        out.append(bytes(obj))
+    elif isinstance(obj, str):
+        raw = _as_base64(obj)
+        if raw is not None:
+            out.append(_head(6, _TAG_BASE64))
+            out.append(_head(2, len(raw)))
+            out.append(raw)
+        else:
+            data = bytes(obj, 'utf-8')
+            out.append(_head(3, len(data)))
+            out.append(data)
+    elif isinstance(obj, (list, tuple)):
+        out.append(_head(4, len(obj)))
+        for item in obj:
+            _encode(item, out)
+    elif isinstance(obj, dict):
+        out.append(_head(5, len(obj)))
+        for key, value in obj.items():
+            _encode(str(key), out)
+            _encode(value, out)
+    else:
+        raise ValueError('Cannot encode %s' % type(obj).__name__)
+
+
+def dumps(obj):
+    """Encode a JSON-like object (or _json_object) as CBOR bytes."""
+    out = []
+    _encode(obj, out)
+    return b''.join(out)
+
+
+class _Decoder:
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def _take(self, n):
+        end = self.pos + n
+        if end > len(self.data):
+            raise ValueError('Truncated CBOR data')
+        chunk = self.data[self.pos:end]
+        self.pos = end
+        return chunk
+
+    def _arg(self, info):
+        if info < 24:
+            return info
+        elif info == 24:
+            return self._take(1)[0]
+        elif info == 25:
+            return struct.unpack('>H', self._take(2))[0]
+        elif info == 26:
+            return struct.unpack('>I', self._take(4))[0]
+        elif info == 27:
+            return struct.unpack('>Q', self._take(8))[0]
+        raise ValueError('Unsupported CBOR length encoding')
+
+    def decode(self, depth=0):
+        if depth > MAX_DEPTH:
+            raise ValueError('CBOR data nested too deeply')
+        ib = self._take(1)[0]
+        major, info = ib >> 5, ib & 0x1f
+
+        if major == 7:
+            if info == 20:
+                return False
+            elif info == 21:
+                return True
+            elif info == 22:
+                return None
+            elif info == 27:
+                return struct.unpack('>d', self._take(8))[0]
+            raise ValueError('Unsupported CBOR simple value')
+
+        n = self._arg(info)
+        if major == 0:
+            return n
+        elif major == 1:
+            return -1 - n
+        elif major == 2:
+            return bytes(self._take(n))
+        elif major == 3:
+            return str(self._take(n), 'utf-8')
+        elif major == 4:
+            # Every item takes at least one byte, which bounds n
+            if n > len(self.data) - self.pos:
+                raise ValueError('Truncated CBOR data')
+            return [self.decode(depth + 1) for i in range(0, n)]
+        elif major == 5:
+            if 2*n > len(self.data) - self.pos:
+                raise ValueError('Truncated CBOR data')
+            result = {}
+            for i in range(0, n):
+                key = self.decode(depth + 1)
+                if not isinstance(key, str):
+                    raise ValueError('CBOR map keys must be text')
+                result[key] = self.decode(depth + 1)
+            return result
+        elif major == 6 and n == _TAG_BASE64:
+            raw = self.decode(depth + 1)
+            if not isinstance(raw, bytes):
+                raise ValueError('Invalid CBOR base64 tag')
+            return str(base64.b64encode(raw), 'latin-1')
+        raise ValueError('Unsupported CBOR tag')
+
+
+def loads(data):
+    """Decode CBOR bytes into JSON-like Python objects."""
+    decoder = _Decoder(data)
+    result = decoder.decode()
+    if decoder.pos != len(decoder.data):
+        raise ValueError('Trailing garbage after CBOR data')
+    return result
+
+
+if __name__ == '__main__':
+    import json
+
+    b64 = str(base64.b64encode(bytes(range(0, 200))), 'latin-1')
+    sample = {
+        'passcrow-escrow-request': '1.0',
+        'parameters-key': 'yCvR9Obg3O5yZzx4fOVMKqF/2njPNR1plLvXOlqc4zY=',
+        'escrow-data': [b64, 'not base64, even if long enough'],
+        'numbers': [0, 23, 24, 255, 256, 65536, 2**40, -1, -500, 1.5],
+        'flags': [True, False, None],
+        'nested': {'unicode': 'Staðfestingarkóði'}}
+
+    encoded = dumps(sample)
+    assert(loads(encoded) == sample)
+    for bad in (encoded[:-1], encoded + b'\x00', b'\x9b' + b'\xff' * 8):
+        try:
+            loads(bad)
+            assert(not 'reached')
+        except ValueError:
+            pass
+
+    print('%d bytes JSON, %d bytes CBOR' % (
+        len(json.dumps(sample, separators=(',', ':'))), len(encoded)))
+    print('ok')
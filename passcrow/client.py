@@ -2,24 +2,33 @@ import datetime
 import base64
 import copy
 import datetime
+import functools
 import json
 import os
 import random
 import re
 import time
 import traceback
+import urllib.error
 import urllib.request
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import appdirs
 
-from .aes_utils import random_aesgcm_key, derive_aesgcm_key
+from .aes_utils import random_aesgcm_key, derive_aesgcm_key, expand_aesgcm_key
 from .aes_utils import aesgcm_key_to_int, aesgcm_key_from_int
 from .handlers.validators import *
-from .util import pmkdir, _json_list, _json_object, _json_object_prop
+from .util import pmkdir, _json_list, _json_object
 from .util import _encrypted_json_object
 from .proto import *
 from .secret_share import random_int, make_random_shares, recover_secret
-from .payments import make_payment
+from .payments import make_payment, rank_payment_schemes, is_prepaid
+from .payments import VoucherWallet
+from .transport import HTTPSPool
+from .pack_index import PackIndex
+from .jobs import JobQueue, new_job_id
+from . import cbor
 
 
 SHARED_CONFIG_DIR = appdirs.user_config_dir('passcrow', roaming=False)
@@ -31,6 +40,43 @@ DEFAULT_M = 4
 DEFAULT_SLEEP_MIN = 0
 DEFAULT_SLEEP_MAX = 600
 
+# Pipelined payments older than this are discarded; servers accept
+# hashcash for about two minutes.
+PIPELINE_MAX_AGE = 60
+
+# How RPC tasks (one per server) are scheduled. Serial with long random
+# sleeps makes it harder for servers to correlate requests by timing,
+# the parallel modes are faster but leak more. Jittered parallel requests
+# are delayed by up to DEFAULT_JITTER_MAX seconds each.
+RPC_SERIAL = 'anonymous serial'
+RPC_JITTERED = 'jittered parallel'
+RPC_PARALLEL = 'fully parallel'
+RPC_MODES = (RPC_SERIAL, RPC_JITTERED, RPC_PARALLEL)
+DEFAULT_RPC_MODE = RPC_SERIAL
+DEFAULT_PARALLELISM = 4
+DEFAULT_JITTER_MAX = 30
+
+# Servers rate limit each client to one request per second, so parallel
+# requests to the same server are sent one at a time, this far apart.
+SERVER_REQUEST_INTERVAL = 1.0
+
+# Server policies are cached on disk, for this long unless the server
+# says otherwise (Cache-Control: max-age=...).
+POLICY_CACHE_FILE = 'server_policies.json'
+DEFAULT_POLICY_TTL = 24 * 3600
+
+# Prepaid vouchers (see `passcrow vouchers`) are kept here
+VOUCHER_WALLET_FILE = 'voucher_wallet.json'
+
+# Bulk protection jobs record their progress in the data directory
+PROGRESS_SUFFIX = '.progress'
+
+# By default, `passcrow renew` renews packs expiring within this many days
+DEFAULT_RENEW_DAYS = 30
+
+# Failed jobs are kept (without any secrets) this long, for inspection
+FAILED_JOB_DAYS = 7
+
 DEFAULT_PACK_DESC = 'Created using python Passcrow'
 DEFAULT_VERIFY_DESC = 'Passcrow Data'
 
@@ -52,7 +98,6 @@ class ServerError(Exception):
 
 class EncryptedBlob(_encrypted_json_object):
     _KEYS = {"data": str}
-    data = property(*_json_object_prop('data'))
 
 
 class EscrowRecord(_json_object):
@@ -62,10 +107,51 @@ class EscrowRecord(_json_object):
         "response": EscrowResponse,
         "recovery-key": str}
 
-    kind = property(*_json_object_prop('kind'))
-    server = property(*_json_object_prop('server'))
-    response = property(*_json_object_prop('response'))
-    recovery_key = property(*_json_object_prop('recovery-key'))
+
+# Ephemeral recovery keys come in two versions:
+#
+#   1: XXXX-XXXX-XXXX-XXXX, each purpose does its own slow scrypt
+#   2: 2-XXXX-XXXX-XXXX-XXXX, one slow scrypt, expanded using HKDF
+#
+# The scrypt derivations are deliberately costly (n=2**20), and protecting
+# or recovering needs the same keys more than once, so results are memoized
+# briefly. Operations call forget_ephemeral_keys() once they are done.
+EPHEMERAL_KEY_VERSION = 2
+EPHEMERAL_MEMO_TTL = 300
+
+_EPHEMERAL_MEMO = {}
+_EPHEMERAL_MEMO_LOCK = threading.Lock()
+
+def _ephemeral_memo(memo_key, derive):
+    now = time.time()
+    with _EPHEMERAL_MEMO_LOCK:
+        for k in [k for k, (ts, v) in _EPHEMERAL_MEMO.items()
+                if ts < now - EPHEMERAL_MEMO_TTL]:
+            del _EPHEMERAL_MEMO[k]
+        if memo_key in _EPHEMERAL_MEMO:
+            return _EPHEMERAL_MEMO[memo_key][1]
+    value = derive()
+    with _EPHEMERAL_MEMO_LOCK:
+        _EPHEMERAL_MEMO[memo_key] = (now, value)
+    return value
+
+def forget_ephemeral_keys():
+    with _EPHEMERAL_MEMO_LOCK:
+        _EPHEMERAL_MEMO.clear()
+
+def _ephemeral_master_key(user_key):
+    return _ephemeral_memo((user_key,), lambda: derive_aesgcm_key(
+        user_key, salt=b'Passcrow Ephemeral v2'))
+
+def _ephemeral_key(user_key, purpose, length=256):
+    if user_key[:2] == b'2-':
+        return expand_aesgcm_key(
+            _ephemeral_master_key(user_key), purpose, length=length)
+    if purpose == b'Pack Key':
+        return _ephemeral_memo((user_key, purpose, length),
+            lambda: derive_aesgcm_key(user_key, length=length))
+    return _ephemeral_memo((user_key, purpose, length),
+        lambda: derive_aesgcm_key(user_key, salt=purpose, length=length))
 
 
 class RecoveryPack(_encrypted_json_object):
@@ -80,16 +166,6 @@ class RecoveryPack(_encrypted_json_object):
         "shares": _json_list(str),
         "escrow": _json_list(EscrowRecord)}
 
-    name = property(*_json_object_prop('name'))
-    secret = property(*_json_object_prop('secret'))
-    created_ts = property(*_json_object_prop('created-ts'))
-    is_ephemeral = property(*_json_object_prop('is-ephemeral'))
-    ephemeral_id = property(*_json_object_prop('ephemeral-id'))
-    description = property(*_json_object_prop('description'))
-    min_shares = property(*_json_object_prop('min-shares'))
-    shares = property(*_json_object_prop('shares'))
-    escrow = property(*_json_object_prop('escrow'))
-
     kinds = property(lambda s: sorted([e.kind for e in s.escrow]))
 
     created = property(
@@ -110,8 +186,11 @@ class RecoveryPack(_encrypted_json_object):
         return [(prefixes.pop(0), esc) for esc in escrowed]
 
     def save(self, filename):
-        with open(filename, 'wb') as fd:
+        # Write and rename, so an existing pack is replaced atomically
+        tmp = filename + (b'.tmp' if isinstance(filename, bytes) else '.tmp')
+        with open(tmp, 'wb') as fd:
             fd.write(bytes(str(self), 'utf-8'))
+        os.replace(tmp, filename)
 
     def load(self, filename):
         with open(filename, 'rb') as fd:
@@ -122,13 +201,13 @@ class RecoveryPack(_encrypted_json_object):
     def ephemeral_escrow_id(cls, key):
         user_key = bytes(key, 'latin-1') if isinstance(key, str) else key
         return str(base64.b16encode(
-                derive_aesgcm_key(user_key, salt=b'Escrow ID', length=128)
+                _ephemeral_key(user_key, b'Escrow ID', length=128)
             ).lower(), 'latin-1')
 
     @classmethod
     def ephemeral_escrow_key(cls, key, b64=False):
         user_key = bytes(key, 'latin-1') if isinstance(key, str) else key
-        escrow_key = derive_aesgcm_key(user_key, salt=b'Escrow Key')
+        escrow_key = _ephemeral_key(user_key, b'Escrow Key')
         if b64:
             return str(base64.b64encode(escrow_key), 'latin-1')
         return escrow_key
@@ -140,21 +219,86 @@ class RecoveryPack(_encrypted_json_object):
                 .replace(b'/', b'').replace(b'+', b'')
                 .replace(b'1', b'').replace(b'l', b'')
                 .replace(b'O', b'').replace(b'0', b''))[:16]
-        user_key = b'%s-%s-%s-%s' % (
+        user_key = b'%d-%s-%s-%s-%s' % (EPHEMERAL_KEY_VERSION,
             user_key[:4], user_key[4:8], user_key[8:12], user_key[12:16])
 
-        self.encrypt(derive_aesgcm_key(user_key), compress=True)
+        self.encrypt(_ephemeral_key(user_key, b'Pack Key'), compress=True)
         ed, self.encrypted_data = self.encrypted_data, None
         return (str(user_key, 'latin-1'), ed)
 
     def decrypt_ephemeral(self, ephemeral_id, data):
         user_key = bytes(ephemeral_id.split(':')[-1], 'latin-1')
         self.encrypted_data = data
-        self.decrypt(derive_aesgcm_key(user_key), decompress=True)
+        self.decrypt(_ephemeral_key(user_key, b'Pack Key'), decompress=True)
         self.name = str(user_key, 'latin-1')
         return self
 
 
+class EscrowJobTask(_json_object):
+    _KEYS = {
+        "server": str,
+        "kind": str,
+        "escrow-data": str,
+        "recovery-key": str,
+        "escrow-data-id": str}
+
+
+class EscrowJob(_json_object):
+    """
+    A protect or delete operation, queued for `PasscrowClient.run_jobs()`.
+    Protect jobs carry the recovery pack under construction; it is
+    saved to the pack database once all the shares have been escrowed.
+    Their tasks hold the (encrypted) escrow data for each server, which
+    gets paid for and wrapped in an EscrowRequest when the time comes.
+
+    Note that the worker must be able to finish the job unattended, so
+    the escrow data is stored along with its key: until it completes, a
+    protect job is as sensitive as the secret itself. Failed jobs are
+    scrubbed of the pack and escrow data, and removed after a while.
+    """
+    _KEYS = {
+        "id": str,
+        "kind": str,
+        "name": str,
+        "created-ts": int,
+        "expiration-days": int,
+        "pack": RecoveryPack,
+        "tasks": _json_list(EscrowJobTask),
+        "failures": int,
+        "max-failures": int,
+        "last-error": str,
+        "failed-ts": int}
+
+    failed = property(lambda s: s.failures >= s.max_failures)
+
+    def scrubbed(self):
+        """A copy of a failed job, without the pack or escrow data."""
+        job = EscrowJob(
+            id=self.id,
+            kind=self.kind,
+            name=self.name,
+            created_ts=self.created_ts,
+            tasks=[EscrowJobTask(server=t.server) for t in self.tasks],
+            failures=self.failures,
+            max_failures=self.max_failures,
+            failed_ts=int(time.time()))
+        if 'last-error' in self:
+            job.last_error = self.last_error
+        return job
+
+    @classmethod
+    def Make(cls, kind, name, tasks):
+        job = cls()
+        job.id = new_job_id()
+        job.kind = kind
+        job.name = name
+        job.created_ts = time.time()
+        job.tasks = tasks
+        job.failures = 0
+        job.max_failures = len(tasks) + 3
+        return job
+
+
 class PasscrowServerPolicy:
     """
     Server policies are expressed as text like so:
@@ -355,6 +499,40 @@ def _default_urlopen(url, data=None, headers={}):
         urllib.request.Request(url, data=data, headers=headers))
 
 
+def _default_transport():
+    # Our keep-alive pool does not know about proxies; urllib does.
+    if urllib.request.getproxies().get('https'):
+        return _default_urlopen
+    return HTTPSPool()
+
+
+def _io(method, *args, **kwargs):
+    return (method, args, kwargs)
+
+
+def _stepwise(steps):
+    """
+    Client operations are written as generators, which yield the slow
+    steps (network I/O) they need done as _io(method name, args...), and
+    receive the results. This turns such a generator into a normal method,
+    which performs the steps synchronously. The generator is kept as the
+    .steps attribute, so AsyncPasscrowClient can run the same code with
+    asyncio instead.
+    """
+    @functools.wraps(steps)
+    def run_steps(self, *args, **kwargs):
+        gen = steps(self, *args, **kwargs)
+        result = None
+        try:
+            while True:
+                method, args, kwargs = gen.send(result)
+                result = getattr(self, method)(*args, **kwargs)
+        except StopIteration as e:
+            return e.value
+    run_steps.steps = steps
+    return run_steps
+
+
 class PasscrowClient:
 
     PACK_SUFFIX = b'.passcrow'
@@ -373,7 +551,10 @@ class PasscrowClient:
 
             sleep_min=None, sleep_max=None, sleep_func=None,
             logging_func=None,
-            urlopen_func=None):
+            urlopen_func=None,
+            wire_format=None,
+            rpc_mode=None,
+            parallelism=None):
 
         self.config_dir = config_dir or SHARED_CONFIG_DIR
         self.data_dir = data_dir or SHARED_DATA_DIR
@@ -382,7 +563,13 @@ class PasscrowClient:
         self.sleep_max = DEFAULT_SLEEP_MAX if sleep_max is None else sleep_max
         self.log = logging_func or print
         self.sleep = sleep_func or time.sleep
-        self.urlopen = urlopen_func or _default_urlopen
+        self.urlopen = urlopen_func or _default_transport()
+        self.wire_format = wire_format or 'json'
+        if self.wire_format not in ('json', 'cbor'):
+            raise ValueError('Unsupported wire format: %s' % self.wire_format)
+        self.rpc_mode = self._check_rpc_mode(rpc_mode or DEFAULT_RPC_MODE)
+        self.parallelism = parallelism or DEFAULT_PARALLELISM
+        self.server_latency = {}
 
         self.default_policy = PasscrowRecoveryPolicy(
             idps=default_ids,
@@ -393,8 +580,14 @@ class PasscrowClient:
             timeout_minutes=default_timeout_minutes,
             default_policy=True)
 
-        # FIXME: Cache these on disk, load on startup
+        # Server policies are cached in RAM and on disk (loaded on demand)
         self.server_policies = {}
+        self._policy_cache = None
+        self._policy_lock = threading.RLock()
+        self._pack_index = None
+        self._wallet = None
+        self._pending_payments = {}
+        self._last_request = {}  # server -> time of our latest request
 
         if env_override:
             self.config_dir = os.getenv('PASSCROW_HOME', self.config_dir)
@@ -425,14 +618,105 @@ class PasscrowClient:
             where = 'home=%s' % self.config_dir
         return ('PasscrowClient(%s)' % where)
 
-    def _get_server_policy(self, server):
-        if server not in self.server_policies:
-            class Policy(dict):
+    def _policy_cache_path(self):
+        return os.path.join(self.data_dir, POLICY_CACHE_FILE)
+
+    def _load_policy_cache(self):
+        with self._policy_lock:
+            if self._policy_cache is None:
+                try:
+                    with open(self._policy_cache_path(), 'r') as fd:
+                        self._policy_cache = json.load(fd)
+                except (OSError, IOError, ValueError):
+                    self._policy_cache = {}
+            return self._policy_cache
+
+    def _save_policy_cache(self):
+        with self._policy_lock:
+            try:
+                tmp = self._policy_cache_path() + '.tmp'
+                with open(tmp, 'w') as fd:
+                    json.dump(self._policy_cache, fd, indent=1)
+                os.replace(tmp, self._policy_cache_path())
+            except (OSError, IOError) as e:
+                self.log('Failed to save policy cache: %s' % e)
+
+    def forget_server_policy(self, server):
+        """Discard any cached policy for a server, so it gets refetched."""
+        with self._policy_lock:
+            self.server_policies.pop(server, None)
+            if self._load_policy_cache().pop(server, None) is not None:
+                self._save_policy_cache()
+
+    def _policy_request(self, server, cached=None):
+        headers = {'Content-type': 'application/json'}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        return 'https://%s/passcrow/policy' % server, b'{}', headers
+
+    def _fetch_server_policy(self, server, cached=None):
+        url, data, headers = self._policy_request(server, cached)
+        try:
+            resp = self.urlopen(url, data=data, headers=headers)
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                raise
+            resp = e
+        return self._parse_policy_response(resp, cached)
+
+    def _parse_policy_response(self, resp, cached):
+        # Note: urlopen_func implementations may not provide headers
+        status = getattr(resp, 'status', None) or 200
+        hdrs = getattr(resp, 'headers', None) or {}
+        if status == 304 and cached:
+            policy = cached['policy']
+        else:
+            policy = json.load(resp)
+
+        ttl = DEFAULT_POLICY_TTL
+        max_age = re.search(r'max-age=(\d+)', hdrs.get('Cache-Control') or '')
+        if max_age:
+            ttl = int(max_age.group(1))
+        return policy, hdrs.get('ETag'), ttl
+
+    def _cached_server_policy(self, server):
+        """
+        Returns a (policy object, cache entry) tuple; the policy object is
+        None if it needs (re)fetching.
+        """
+        with self._policy_lock:
+            po = self.server_policies.get(server)
+            if po is not None:
+                return po, None
+            cached = self._load_policy_cache().get(server)
+
+        if cached and cached.get('expires', 0) > time.time():
+            try:
+                po = PolicyObject.from_json(cached['policy'])
+                with self._policy_lock:
+                    return self.server_policies.setdefault(server, po), cached
+            except (KeyError, TypeError, ValueError):
                 pass
-            po = PolicyObject(self._rpc(server, Policy()))
-            self.server_policies[server] = po
+        return None, cached
+
+    def _remember_server_policy(self, server, policy, etag, ttl):
+        po = PolicyObject.from_json(policy)
+        with self._policy_lock:
+            self._load_policy_cache()[server] = {
+                'policy': policy,
+                'etag': etag,
+                'expires': int(time.time() + ttl)}
+            self._save_policy_cache()
+            return self.server_policies.setdefault(server, po)
+
+    def _get_server_policy(self, server):
+        po, cached = self._cached_server_policy(server)
+        if po is None:
+            po = self._remember_server_policy(
+                server, *self._fetch_server_policy(server, cached))
+            self._last_request[server] = time.time()
             self.sleep(1.5)  # Play nice with rate limits
-        return self.server_policies[server]
+        return po
 
     def _packfilename(self, name):
         data_dir = bytes(self.data_dir, 'utf-8')
@@ -444,36 +728,133 @@ class PasscrowClient:
             fn = b'_' + base64.b32encode(bytes(name, 'utf-8'))
         return os.path.join(data_dir, fn + self.PACK_SUFFIX)
 
+    def _packname(self, fn):
+        fn = fn if isinstance(fn, bytes) else bytes(fn, 'utf-8')
+        pn = fn[:-len(self.PACK_SUFFIX)]
+        if pn[:1] in (b'_'):
+            return str(base64.b32decode(pn[1:]), 'utf-8')
+        return str(pn, 'utf-8')
+
     def __iter__(self):
         data_dir = bytes(self.data_dir, 'utf-8')
         for fn in sorted(os.listdir(data_dir)):
             if fn.endswith(self.PACK_SUFFIX):
-                pn = fn[:-len(self.PACK_SUFFIX)]
-                if pn[:1] in (b'_'):
-                    name = str(base64.b32decode(pn[1:]), 'utf-8')
-                else:
-                    name = str(pn, 'utf-8')
+                name = self._packname(fn)
                 yield (name, RecoveryPack().load(self._packfilename(name)))
 
-    def _make_payment(self, idp, expiration, data):
-        policy = self._get_server_policy(idp.server)
-        plist = sorted([(p.expiration_seconds, p)
-            for p in policy.payment_schemes])
-        avail = [pp for exp, pp in plist if exp >= expiration]
+    def _get_pack_index(self):
+        if self._pack_index is None:
+            self._pack_index = PackIndex(
+                self.data_dir, self.PACK_SUFFIX, self._packname,
+                lambda path: RecoveryPack().load(path))
+        return self._pack_index
+
+    def _save_pack(self, name, pack):
+        path = self._packfilename(name)
+        pack.save(path)
+        self._get_pack_index().update(path, pack)
+
+    def _remove_pack(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        self._get_pack_index().remove(path)
+
+    def list_packs(self, server=None, kind=None, expires_before=None):
+        """
+        List metadata (PackInfo objects) for our recovery packs, optionally
+        only those stored on a given server, using a given kind of identity,
+        or expiring before a given time. This uses the pack index, so is
+        much faster than iterating over the packs themselves.
+        """
+        return self._get_pack_index().find(
+            server=server, kind=kind, expires_before=expires_before)
+
+    def _prefetch_server_policies(self, idps, expiration):
+        """
+        Fetch the policies of all the servers we are about to use, in
+        parallel, and make sure each of them can actually store our data:
+        it is better to fail before escrowing anything than halfway.
+        """
+        servers = self._policy_servers(idps)
+        if not servers:
+            return
+        with ThreadPoolExecutor(
+                max_workers=min(len(servers), self.parallelism)) as pool:
+            policies = dict(zip(servers,
+                pool.map(self._get_server_policy, servers)))
+        self._check_server_policies(idps, expiration, policies)
+
+    def _policy_servers(self, idps):
+        servers = []
+        for idp in idps:
+            if idp.server and idp.server not in servers:
+                servers.append(idp.server)
+        return servers
+
+    def _check_server_policies(self, idps, expiration, policies):
+        for idp in idps:
+            if not (idp.id and idp.server):
+                continue
+            kind = idp.id.split(':')[0]
+            kinds = policies[idp.server].kinds
+            if kinds and kind not in kinds:
+                raise ValueError('%s does not support %s identities'
+                    % (idp.server, kind))
+            self._choose_payment_scheme(idp.server, expiration)
+
+    def _get_wallet(self):
+        if self._wallet is None:
+            self._wallet = VoucherWallet(
+                os.path.join(self.data_dir, VOUCHER_WALLET_FILE))
+        return self._wallet
+
+    def add_vouchers(self, scheme_id, vouchers):
+        """Add prepaid vouchers (as issued by a server) to our wallet."""
+        self._get_wallet().add(scheme_id, vouchers)
+
+    def voucher_counts(self):
+        """Returns a dict of how many vouchers we have, by scheme-id."""
+        return self._get_wallet().counts()
+
+    def _make_payment(self, server, expiration, data, request):
+        scheme = self._choose_payment_scheme(server, expiration)
+        payment = make_payment(scheme, data, wallet=self._get_wallet())
+        if is_prepaid(scheme):
+            # Keep a reference to the request, so its id stays unique
+            self._pending_payments[id(request)] = (request, payment)
+        return payment
+
+    def _settle_payment(self, request, spent):
+        """
+        Prepaid vouchers are only removed from the wallet once a server
+        has responded to the request they paid for; otherwise they are
+        released for reuse.
+        """
+        pending = self._pending_payments.pop(id(request), None)
+        if pending is not None:
+            self._get_wallet().settle(pending[1], spent)
+
+    def _choose_payment_scheme(self, server, expiration):
+        policy = self._get_server_policy(server)
+        wallet = self._get_wallet()
+        plist = rank_payment_schemes(policy.payment_schemes, wallet)
+        if not plist:
+            raise ValueError('No usable payment schemes on %s' % server)
+        avail = [pp for pp in plist if pp.expiration_seconds >= expiration]
         if not avail:
-            max_exp, unit = plist[-1][0] / 60, 'minutes'
+            max_exp = max(pp.expiration_seconds for pp in plist) / 60
+            unit = 'minutes'
             if max_exp > 120:
                 max_exp /= 60
                 unit = 'hours'
             if max_exp > 72:
                 max_exp /= 24
                 unit = 'days'
-            raise ValueError('Maximum server escrow time is too short: %d %s'
-                % (max_exp, unit))
-        return make_payment(avail[0], data)
+            raise ValueError('Maximum server escrow time on %s is too short: %d %s'
+                % (server, max_exp, unit))
+        return avail[0]
 
-    def _make_escrow_request(self, share, description, idp, policy,
-            escrow_key=None, escrow_id=None):
+    def _make_escrow_data(self, share, description, idp, escrow_key=None):
         erd = EscrowRequestData()
         erd.description = description
         erd.secret = share
@@ -481,55 +862,269 @@ class PasscrowClient:
         erd.timeout = idp.get_timeout()
         if idp.notify:
             erd.notify = idp.notify
-        erd.encrypt(escrow_key or random_aesgcm_key())
+        return erd.encrypt(escrow_key or random_aesgcm_key())
 
+    def _make_escrow_request(self, share, description, idp, policy,
+            escrow_key=None, escrow_id=None):
+        erd = self._make_escrow_data(share, description, idp, escrow_key)
+        er = self._wrap_escrow_data(str(erd), idp.server,
+            idp.id.split(':')[0], policy.expiration_days, escrow_id)
+        return er, erd.encryption_key
+
+    def _wrap_escrow_data(self, erd, server, kind, expiration_days,
+            escrow_id=None):
+        """
+        Pay for (already encrypted) escrow data and wrap it in an
+        EscrowRequest for the server.
+        """
         erp = EscrowRequestParameters()
-        erp.kind = idp.id.split(':')[0]
-        erp.expiration = policy.expiration_days
-        erp.expiration *= (24 * 3600)
-        erp.payment = self._make_payment(idp, erp.expiration, str(erd))
+        erp.kind = kind
+        erp.expiration = expiration_days * 24 * 3600
+        er = EscrowRequest()
+        erp.payment = self._make_payment(server, erp.expiration, erd, er)
         erp.expiration += int(time.time())
         if escrow_id:
             erp.prefer_id = escrow_id
         erp.encrypt(random_aesgcm_key())
 
-        er = EscrowRequest()
         er.parameters = erp
         er.parameters_key = erp.encryption_key
         er.escrow_data = [erd]
-        return er, erd.encryption_key
+        return er
 
-    def _rpc(self, server, request):
+    def _use_cbor(self, server, rpc_method):
+        # Policies are always fetched as JSON, since that is how we learn
+        # whether the server speaks anything else.
+        if self.wire_format != 'cbor' or rpc_method in ('policy', 'stats'):
+            return False
+        policy = self._get_server_policy(server)
+        return (PASSCROW_CBOR_VERSION in (policy.passcrow_versions or []))
+
+    def _encode_rpc(self, server, request):
+        """Returns the URL, body, headers and decoder for an RPC."""
         rpc_method = type(request).__name__.lower()
-        return json.load(
-            self.urlopen(
-                'https://%s/passcrow/%s' % (server, rpc_method),
-                data=bytes(str(request), 'latin-1'),
-                headers={'Content-type': 'application/json'}))
+        url = 'https://%s/passcrow/%s' % (server, rpc_method)
+        if self._use_cbor(server, rpc_method):
+            return (url, cbor.dumps(request),
+                {'Content-type': cbor.CONTENT_TYPE}, cbor.loads)
+        return (url, bytes(request),
+            {'Content-type': 'application/json'}, json.loads)
+
+    def _rpc(self, server, request):
+        url, data, headers, decode = self._encode_rpc(server, request)
+        return decode(self.urlopen(url, data=data, headers=headers).read())
+
+    def _prep_later(self, prep, task, sleeptime, delay, abandoned):
+        # Wait on an event rather than sleeping, so if the loop gives up
+        # on us we neither linger nor mint hashcash nobody will use.
+        if abandoned.wait(delay):
+            return None, 0, 0
+        t0 = time.time()
+        prepared = prep(task, sleeptime)
+        return prepared, t0, time.time()
+
+    def _discard_prepared(self, future):
+        try:
+            prepared = future.result()[0]
+        except Exception:
+            return
+        if prepared is not None:
+            self._settle_payment(prepared[1], False)
+
+    def _check_rpc_mode(self, mode):
+        if mode not in RPC_MODES:
+            raise ValueError('Unsupported RPC mode: %s' % mode)
+        return mode
+
+    def _by_latency(self, tasks, server_of):
+        """Sort tasks so the historically fastest servers come first."""
+        return sorted(tasks,
+            key=lambda t: self.server_latency.get(server_of(t), 0))
+
+    def _run_rpc_task(self, task, prepared, post, fmt_fail):
+        """Run a prepared task, returning None or a failure description."""
+        server, req, extras = prepared
+        try:
+            t0 = time.time()
+            resp = self._rpc(server, req)
+            self._rpc_task_done(task, prepared, post, resp, time.time() - t0)
+            self._settle_payment(req, True)
+            return None
+        except KeyboardInterrupt:
+            self._settle_payment(req, False)
+            raise
+        except Exception as e:
+            self._rpc_task_failed(req, e)
+            return fmt_fail(task, server, req, extras, e)
+
+    def _rpc_task_failed(self, req, e):
+        # If the server rejected our payment, it will not accept it later
+        # either; any other failure leaves it available for a retry.
+        self._settle_payment(req,
+            isinstance(e, ServerError) and 'payment' in str(e))
+
+    def _rpc_task_done(self, task, prepared, post, resp, elapsed):
+        server, req, extras = prepared
+        avg = self.server_latency.get(server)
+        self.server_latency[server] = elapsed if (avg is None) else (
+            0.7 * avg + 0.3 * elapsed)
+        if 'error' in resp:
+            raise ServerError(resp['error'])
+        post(task, server, req, resp, extras)
+
+    def _rpc_task_loop(self, tasks, prep, post, fmt_fail, failures, quick,
+            pipeline=False, mode=None, quorum=None, spare=0):
+        """
+        Run tasks one at a time, sleeping a random amount between them,
+        or concurrently if a parallel mode is requested.
+
+        If pipeline is set, each task is prepared (e.g. hashcash minted) in
+        a background thread while the previous one is in flight, starting
+        "just in time" before its sleep ends, since payments expire. Stale
+        preparations are discarded and redone.
+
+        If a quorum is given, we stop as soon as that many tasks have
+        succeeded, and remaining tasks are skipped. In the parallel modes,
+        up to `spare` tasks beyond the quorum may be in flight at once;
+        whichever finish first count. Returns True if the quorum was met
+        or, without a quorum, if all tasks succeeded.
+        """
+        mode = self._check_rpc_mode(mode or self.rpc_mode)
+        if mode != RPC_SERIAL:
+            return self._rpc_task_fanout(tasks, prep, post, fmt_fail,
+                failures, quick,
+                jitter=(mode == RPC_JITTERED), quorum=quorum, spare=spare)
 
-    def _rpc_task_loop(self, tasks, prep, post, fmt_fail, failures, quick):
         sleeptime = 0
         max_tries = len(tasks) + 3
-        while tasks and len(failures) < max_tries:
-            self.sleep(sleeptime)  # Has to happen before prep, since hashcash
-                                   # work (in prep) is time critical.
-            task = tasks.pop(0)
-            server, req, extras = prep(task, sleeptime)
-            try:
-                resp = self._rpc(server, req)
-                if 'error' in resp:
-                    raise ServerError(resp['error'])
-                post(task, server, req, resp, extras)
-            except KeyboardInterrupt:
-                raise
-            except Exception as e:
-                failures.append(fmt_fail(task, server, req, extras, e))
-                tasks.append(task)
-                self.log(failures[-1])
-
-            sleeptime = random.randint(self.sleep_min, self.sleep_max)
-            if quick:
-                sleeptime = 1
+        prep_time = 0
+        successes = 0
+        ahead = None
+        background = ThreadPoolExecutor(max_workers=1) if pipeline else None
+        abandoned = threading.Event()
+        try:
+            while tasks and len(failures) < max_tries:
+                if quorum and successes >= quorum:
+                    break
+                self.sleep(sleeptime)  # Has to happen before prep, since
+                                       # hashcash work (in prep) is time
+                                       # critical.
+                task = tasks.pop(0)
+                prepared = None
+                if ahead is not None and ahead[0] is task:
+                    prepared, t0, t1 = ahead[1].result()
+                    prep_time = t1 - t0
+                    if time.time() - t1 > PIPELINE_MAX_AGE:
+                        self._settle_payment(prepared[1], False)
+                        prepared = None
+                ahead = None
+                if prepared is None:
+                    t0 = time.time()
+                    prepared = prep(task, sleeptime)
+                    prep_time = time.time() - t0
+
+                sleeptime = random.randint(self.sleep_min, self.sleep_max)
+                if quick:
+                    sleeptime = 1
+                if background is not None and tasks and not (
+                        quorum and successes + 1 >= quorum):
+                    lead = min(1 + 1.5 * prep_time, PIPELINE_MAX_AGE / 2)
+                    ahead = (tasks[0], background.submit(self._prep_later,
+                        prep, tasks[0], sleeptime, max(0, sleeptime - lead),
+                        abandoned))
+
+                failure = self._run_rpc_task(task, prepared, post, fmt_fail)
+                if failure:
+                    failures.append(failure)
+                    tasks.append(task)
+                    self.log(failure)
+                else:
+                    successes += 1
+        finally:
+            if background is not None:
+                abandoned.set()
+                if ahead is not None and not ahead[1].cancel():
+                    ahead[1].add_done_callback(self._discard_prepared)
+                background.shutdown(wait=False)
+        if quorum:
+            return (successes >= quorum)
+        return (not tasks)
+
+    def _request_wait(self, server):
+        """How long to wait before our next request to a server."""
+        return max(0, self._last_request.get(server, 0)
+            + SERVER_REQUEST_INTERVAL - time.time())
+
+    def _rpc_task_fanout(self, tasks, prep, post, fmt_fail, failures, quick,
+            jitter=False, quorum=None, spare=0):
+        """
+        Run tasks concurrently, at most self.parallelism at a time. Failed
+        tasks are retried, with the same limit on the total number of
+        failures as the serial loop. Only requests to different servers
+        are in flight at once; see SERVER_REQUEST_INTERVAL.
+        """
+        max_tries = len(tasks) + 3
+        jitter_max = 0
+        if jitter:
+            jitter_max = 1 if quick else min(self.sleep_max, DEFAULT_JITTER_MAX)
+
+        # Once we have reached our quorum, late results are discarded.
+        lock = threading.Lock()
+        finished = []
+        def quorum_post(*args):
+            with lock:
+                if not finished:
+                    post(*args)
+
+        # One request at a time per server, see SERVER_REQUEST_INTERVAL
+        gates = {}
+        def run(task):
+            delay = random.uniform(0, jitter_max) if jitter_max else 0
+            self.sleep(delay)
+            prepared = prep(task, delay)
+            with lock:
+                gate = gates.setdefault(prepared[0], threading.Lock())
+            with gate:
+                if finished:
+                    self._settle_payment(prepared[1], False)
+                    return None
+                # Not self.sleep(): this is for the server, not anonymity
+                time.sleep(self._request_wait(prepared[0]))
+                try:
+                    return self._run_rpc_task(
+                        task, prepared, quorum_post, fmt_fail)
+                finally:
+                    self._last_request[prepared[0]] = time.time()
+
+        pool = ThreadPoolExecutor(max_workers=self.parallelism)
+        running = {}
+        successes = 0
+        try:
+            while (tasks or running) and len(failures) < max_tries:
+                if quorum and successes >= quorum:
+                    break
+                limit = self.parallelism
+                if quorum:
+                    limit = min(limit, quorum + spare - successes)
+                while tasks and len(running) < limit:
+                    task = tasks.pop(0)
+                    running[pool.submit(run, task)] = task
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    task = running.pop(fut)
+                    failure = fut.result()
+                    if failure:
+                        failures.append(failure)
+                        tasks.append(task)
+                        self.log(failure)
+                    else:
+                        successes += 1
+        finally:
+            with lock:
+                finished.append(True)
+            pool.shutdown(wait=not quorum, cancel_futures=True)
+        if quorum:
+            return (successes >= quorum)
         return (not tasks)
 
     def pack(self, name):
@@ -557,11 +1152,23 @@ class PasscrowClient:
                     pass
             raise OSError(ose)
 
+    @_stepwise
     def protect(self, name, secret, policy,
             quick=False,
             ephemeral=False,
             pack_description=DEFAULT_PACK_DESC,
-            verify_description=DEFAULT_VERIFY_DESC):
+            verify_description=DEFAULT_VERIFY_DESC,
+            mode=None,
+            background=False):
+        """
+        Protect a secret, escrowing shares of its key with the servers
+        named in the policy. If `background` is set, the escrow requests
+        are queued as a job instead (see run_jobs()) and the job ID is
+        returned right away; the pack is saved once the job completes.
+        """
+        if background and ephemeral:
+            raise ValueError('Ephemeral packs cannot be created in background')
+
         # Create our RecoveryPack object
         recovery_pack = RecoveryPack()
         recovery_pack.name = name
@@ -583,6 +1190,11 @@ class PasscrowClient:
         if ephemeral and len(policy.idps) < 2:
             raise ValueError(
                 'Ephemeral protection requires at least 2 identities')
+        # Background jobs fetch (and check) policies when they run, which
+        # may well be after our cached policies have gone stale.
+        if not background:
+            yield _io('_prefetch_server_policies',
+                policy.idps, policy.expiration_days * 24 * 3600)
         reserve = 1 if ephemeral else 0
         n, m = policy.absolute_ratio(reserve=reserve)
         recovery_pack.min_shares = n
@@ -601,6 +1213,25 @@ class PasscrowClient:
         recovery_pack.shares = shares[-extra:]
         shares = shares[:-extra]
 
+        if background:
+            tasks = []
+            for idp in policy.idps:
+                if not (idp.id and idp.server):
+                    raise ValueError('Need an ID and server: %s' % idp)
+                erd = self._make_escrow_data(
+                    shares.pop(0), verify_description, idp)
+                tasks.append(EscrowJobTask(
+                    server=idp.server,
+                    kind=idp.id.split(':')[0],
+                    escrow_data=str(erd),
+                    recovery_key=erd.encryption_key))
+            recovery_pack.escrow = []
+            job = EscrowJob.Make('protect', name, tasks)
+            job.pack = recovery_pack
+            job.expiration_days = policy.expiration_days
+            self.log('Queued escrow of %s as job %s' % (name, job.id))
+            return self._get_job_queue().save(job)
+
         # For each ID policy, as server to store Cn, add Hn to pack
         escrowed = []
         failures = []
@@ -620,18 +1251,24 @@ class PasscrowClient:
                 share, verify_description, idp, policy, **mer_kwargs)
             return (idp.server, ereq, erec)
         def post(task, server, req, resp, erec):
-            erec.response = EscrowResponse(resp)
+            erec.response = EscrowResponse.from_json(resp)
             escrowed.append(erec)
         def post_ephemeral(task, server, req, resp, erec):
-            erec.response = r = EscrowResponse(resp)
+            erec.response = r = EscrowResponse.from_json(resp)
             escrowed.append(erec)
             if r.escrow_data_id != task[-1]['escrow_id']:
                 raise ValueError('Server refused ephemeral escrow ID')
         def fmt_fail(task, server, req, extras, e):
+            # The server's prices may have changed since we cached its
+            # policy (e.g. load-adaptive hashcash); refetch on retry.
+            if isinstance(e, ServerError) and 'payment' in str(e):
+                self.forget_server_policy(server)
             return '%s via %s: %s' % (task[0].id, server, e)
 
         tasks = [(idp, shares.pop(0), {}) for idp in policy.idps[reserve:]]
-        ok = self._rpc_task_loop(tasks, prep, post, fmt_fail, failures, quick)
+        ok = yield _io('_rpc_task_loop',
+            tasks, prep, post, fmt_fail, failures, quick,
+            pipeline=True, mode=mode)
         recovery_pack.escrow = escrowed
         if not ok:
             return False
@@ -641,28 +1278,226 @@ class PasscrowClient:
             mer_kwargs = {
                 'escrow_id': recovery_pack.ephemeral_escrow_id(user_key),
                 'escrow_key': recovery_pack.ephemeral_escrow_key(user_key)}
-            ok = self._rpc_task_loop(
+            forget_ephemeral_keys()
+            ok = yield _io('_rpc_task_loop',
                 [(policy.idps[0], epack, mer_kwargs)],
-                prep, post_ephemeral, fmt_fail, failures, quick)
+                prep, post_ephemeral, fmt_fail, failures, quick, mode=mode)
             if ok:
                 e = escrowed[-1]
                 if ephemeral == EPHEMERAL_BOTH:
                     recovery_pack.escrow = escrowed
                     recovery_pack.ephemeral_id = '%s:%s' % (e.server, user_key)
-                    recovery_pack.save(self._packfilename(name))
+                    self._save_pack(name, recovery_pack)
                 e.recovery_key = user_key
                 return e
             else:
                 return False
         else:
             # Write recovery pack to local database
-            recovery_pack.save(self._packfilename(name))
+            self._save_pack(name, recovery_pack)
+
+        return True
 
+    def _progress_filename(self, what, job):
+        return os.path.join(self.data_dir, '%s-%s%s' % (what,
+            str(base64.b32encode(bytes(job, 'utf-8')), 'utf-8').rstrip('='),
+            PROGRESS_SUFFIX))
+
+    def _run_many(self, what, func, items, workers, job):
+        """
+        Run func(name, secret) for each item, up to `workers` at a time,
+        recording progress of the named job (if any) as we go.
+        """
+        workers = workers or self.parallelism
+        progress = self._progress_filename(what, job) if job else None
+        done = set()
+        if progress and os.path.exists(progress):
+            with open(progress, 'r') as fd:
+                done = set(json.loads(line) for line in fd if line.strip())
+            self.log('Resuming job %s, %d items already done'
+                % (job, len(done)))
+
+        results = {}
+        lock = threading.Lock()
+        def _run(name, secret):
+            try:
+                result = func(name, secret)
+            except (IOError, OSError, ValueError, KeyError) as e:
+                self.log('Failed to %s %s: %s' % (what, name, e))
+                result = e
+            with lock:
+                results[name] = result
+                if progress and result is True:
+                    with open(progress, 'a') as fd:
+                        fd.write(json.dumps(name) + '\n')
+            return result
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = set()
+            for name, secret in items:
+                if name in done:
+                    continue
+                if len(pending) >= workers * 2:
+                    finished, pending = wait(
+                        pending, return_when=FIRST_COMPLETED)
+                pending.add(pool.submit(_run, name, secret))
+            wait(pending)
+
+        if progress and all(r is True for r in results.values()):
+            try:
+                os.remove(progress)
+            except (OSError, IOError):
+                pass
+        return results
+
+    def protect_many(self, items, policy,
+            quick=False,
+            job=None,
+            workers=None,
+            pack_description=DEFAULT_PACK_DESC,
+            verify_description=DEFAULT_VERIFY_DESC,
+            mode=None):
+        """
+        Protect many secrets with the same policy. The items are an
+        iterable of (name, secret) pairs, which is consumed lazily so
+        large batches need not fit in RAM. Up to `workers` secrets
+        (default: our parallelism) are protected at a time; server
+        policies are fetched once and connections are reused throughout.
+
+        Each pack is written as soon as its shares are escrowed. If a
+        `job` name is given, completed items are also recorded in a
+        progress file in the data directory, so re-running the same job
+        after a crash skips over work which was already done. The file
+        is removed once a job completes without failures.
+
+        Returns a dict mapping the names processed in this run to the
+        result of protect() (False or an exception on failure).
+        """
+        # Fail early if the servers cannot store our data at all
+        self._prefetch_server_policies(
+            policy.idps, policy.expiration_days * 24 * 3600)
+
+        return self._run_many('protect',
+            lambda name, secret: self.protect(name, secret, policy,
+                quick=quick,
+                pack_description=pack_description,
+                verify_description=verify_description,
+                mode=mode),
+            items, workers, job)
+
+    def expiring_packs(self, days=DEFAULT_RENEW_DAYS):
+        """List (PackInfo for) the packs expiring within `days` days."""
+        return sorted(
+            self.list_packs(expires_before=time.time() + days * 24 * 3600),
+            key=lambda info: (info.expires_ts, info.name))
+
+    @_stepwise
+    def renew(self, name, secret, policy,
+            quick=False,
+            pack_description=DEFAULT_PACK_DESC,
+            verify_description=DEFAULT_VERIFY_DESC,
+            mode=None,
+            background=False):
+        """
+        Renew a recovery pack before it expires. The protocol has no way
+        to extend an escrow, and we do not keep the escrowed shares, so
+        this requires the secret itself: it is protected anew and the
+        fresh pack replaces the old one (atomically) once all the new
+        shares are in escrow. The old escrow IDs are then deleted from
+        the servers, or a job to do so is queued if `background` is set.
+        """
+        old_pack = self.pack(name)
+        if 'ephemeral-id' in old_pack or (
+                'is-ephemeral' in old_pack and old_pack.is_ephemeral):
+            raise ValueError('Cannot renew ephemeral pack: %s' % name)
+
+        ok = yield from PasscrowClient.protect.steps(
+            self, name, secret, policy,
+            quick=quick,
+            pack_description=pack_description,
+            verify_description=verify_description,
+            mode=mode)
+        if not ok:
+            return False
+
+        retired = [esc for esc in old_pack.escrow if 'response' in esc]
+        if not retired:
+            return True
+        job = EscrowJob.Make('renew', name, [
+            EscrowJobTask(
+                server=esc.server,
+                escrow_data_id=esc.response.escrow_data_id)
+            for esc in retired])
+        if background:
+            self.log('Queued deletion of old escrow for %s as job %s'
+                % (name, job.id))
+            self._get_job_queue().save(job)
+            return True
+
+        failures = []
+        def prep(task, delay):
+            dreq = DeletionRequest()
+            dreq.escrow_data_id = task.escrow_data_id
+            self.log(
+                'Slept %3.3ds. Deleting old %s from escrow on %s'
+                % (delay, task.escrow_data_id, task.server))
+            return task.server, dreq, None
+        def fmt_fail(task, server, dreq, extras, e):
+            return '%s via %s: %s' % (task.escrow_data_id, server, e)
+        ok = yield _io('_rpc_task_loop',
+            job.tasks, prep, lambda *a: None, fmt_fail, failures, quick,
+            mode=mode)
+        if not ok:
+            # The new pack is in place, so this is not fatal; but we
+            # should not forget about the stale escrow either.
+            self._get_job_queue().save(job)
+            self.log('Queued remaining deletions for %s as job %s'
+                % (name, job.id))
         return True
 
-    def delete(self, name, remote=True, quick=False):
+    def renew_many(self, items, policy,
+            quick=False,
+            job=None,
+            workers=None,
+            pack_description=DEFAULT_PACK_DESC,
+            verify_description=DEFAULT_VERIFY_DESC,
+            mode=None,
+            background=False):
+        """
+        Renew many packs, taking an iterable of (name, secret) pairs. This
+        works like protect_many(), but calls renew() for each item.
+        """
+        self._prefetch_server_policies(
+            policy.idps, policy.expiration_days * 24 * 3600)
+
+        return self._run_many('renew',
+            lambda name, secret: self.renew(name, secret, policy,
+                quick=quick,
+                pack_description=pack_description,
+                verify_description=verify_description,
+                mode=mode,
+                background=background),
+            items, workers, job)
+
+    @_stepwise
+    def delete(self, name, remote=True, quick=False, mode=None,
+            background=False):
+        """
+        Delete a recovery pack, and (if `remote` is set) the escrowed data
+        it refers to. If `background` is set, the deletion requests are
+        queued as a job and its ID returned; the local pack is removed once
+        the servers have all deleted their data.
+        """
         path = self._packfilename(name)
         ok, failures = True, []
+        if remote and background:
+            job = EscrowJob.Make('delete', name, [
+                EscrowJobTask(
+                    server=esc.server,
+                    escrow_data_id=esc.response.escrow_data_id)
+                for esc in self.pack(name).escrow])
+            self.log('Queued deletion of %s as job %s' % (name, job.id))
+            return self._get_job_queue().save(job)
         if remote:
             def prep(esc, delay):
                 dreq = DeletionRequest()
@@ -672,27 +1507,173 @@ class PasscrowClient:
                     % (delay, _id, esc.server))
                 return esc.server, dreq, _id
             def post(esc, server, dreq, resp, _id):
-                response = DeletionResponse(resp)
+                response = DeletionResponse.from_json(resp)
             def fmt_fail(esc, server, dreq, _id, e):
                 return '%s via %s: %s' % (_id, server, e)
 
             pack = self.pack(name)
             escrowed = copy.copy(pack.escrow)
-            ok = self._rpc_task_loop(
-                escrowed, prep, post, fmt_fail, failures, quick)
+            ok = yield _io('_rpc_task_loop',
+                escrowed, prep, post, fmt_fail, failures, quick, mode=mode)
         if ok and os.path.exists(path):
             try:
-                os.remove(path)
+                self._remove_pack(path)
             except (OSError, IOError) as e:
                 failures.append(e)
         return (not failures)
 
+    def _get_job_queue(self):
+        return JobQueue(self.data_dir, EscrowJob.from_json)
+
+    def get_job(self, job_id):
+        """Returns a queued job, or None if it has completed."""
+        return self._get_job_queue().get(job_id)
+
+    def list_jobs(self):
+        return self._expire_failed_jobs(self._get_job_queue())
+
+    def _expire_failed_jobs(self, queue, now=None):
+        """
+        Scrub failed jobs which still hold secrets, remove those which
+        failed over FAILED_JOB_DAYS ago. Returns the remaining jobs.
+        """
+        cutoff = (now or time.time()) - FAILED_JOB_DAYS * 24 * 3600
+        jobs = []
+        for job in queue.jobs():
+            if job.failed:
+                if 'failed-ts' not in job:
+                    job = job.scrubbed()
+                    queue.save(job)
+                elif job.failed_ts < cutoff:
+                    queue.remove(job.id)
+                    continue
+            jobs.append(job)
+        return jobs
+
+    def _job_handlers(self):
+        # Each kind of job has functions to prepare a request for a task,
+        # process the server's response and finish the job when done.
+        return {
+            'protect': (
+                self._protect_job_prep,
+                self._protect_job_post,
+                lambda job: self._save_pack(job.name, job.pack)),
+            'delete': (
+                self._delete_job_prep,
+                lambda job, task, resp, extras: None,
+                lambda job: self._remove_pack(self._packfilename(job.name))),
+            # Deleting escrow which has been superseded by renewal
+            'renew': (
+                self._delete_job_prep,
+                lambda job, task, resp, extras: None,
+                lambda job: None)}
+
+    def _protect_job_prep(self, job, task, delay):
+        self.log(
+            'Slept %3.3ds. Escrow share for %s with %s (job %s)'
+            % (delay, task.kind, task.server, job.id))
+        erec = EscrowRecord()
+        erec.kind = task.kind
+        erec.server = task.server
+        erec.recovery_key = task.recovery_key
+        ereq = self._wrap_escrow_data(task.escrow_data,
+            task.server, task.kind, job.expiration_days)
+        return (task.server, ereq, erec)
+
+    def _protect_job_post(self, job, task, resp, erec):
+        erec.response = EscrowResponse.from_json(resp)
+        job.pack.escrow.append(erec)
+
+    def _delete_job_prep(self, job, task, delay):
+        dreq = DeletionRequest()
+        dreq.escrow_data_id = task.escrow_data_id
+        self.log(
+            'Slept %3.3ds. Deleting %s from escrow on %s (job %s)'
+            % (delay, task.escrow_data_id, task.server, job.id))
+        return task.server, dreq, None
+
+    def run_jobs(self, quick=False, max_tasks=None):
+        """
+        Work through the job queue, one task at a time with random sleeps
+        in between (as in the anonymous serial RPC mode). Tasks from
+        different jobs are interleaved at random. Each job is saved after
+        every task, so this can safely be interrupted and resumed later.
+        Jobs which fail too often are left in the queue, but skipped.
+
+        Returns the number of tasks which completed successfully.
+        """
+        queue = self._get_job_queue()
+        handlers = self._job_handlers()
+        def pending():
+            return [(job, i) for job in queue.jobs() if not job.failed
+                for i in range(0, len(job.tasks))]
+        def post(job_task, server, req, resp, extras):
+            job, i = job_task
+            handlers[job.kind][1](job, job.tasks[i], resp, extras)
+        def fmt_fail(job_task, server, req, extras, e):
+            if isinstance(e, ServerError) and 'payment' in str(e):
+                self.forget_server_policy(server)
+            return '%s job %s via %s: %s' % (
+                job_task[0].kind, job_task[0].id, server, e)
+
+        sleeptime, attempts, completed = 0, 0, 0
+        with queue.lock(stale_after=self.sleep_max + 3600):
+            self._expire_failed_jobs(queue)
+            while (max_tasks is None or attempts < max_tasks) and pending():
+                self.sleep(sleeptime)
+                queue.touch_lock()
+                tasks = pending()  # Jobs may have changed while we slept
+                if not tasks:
+                    break
+                job, i = random.choice(tasks)
+                prep, _, finish = handlers[job.kind]
+                attempts += 1
+                try:
+                    prepared = prep(job, job.tasks[i], sleeptime)
+                    failure = self._run_rpc_task(
+                        (job, i), prepared, post, fmt_fail)
+                except (ValueError, KeyError, IOError, OSError) as e:
+                    failure = '%s job %s: %s' % (job.kind, job.id, e)
+
+                if failure:
+                    self.log(failure)
+                    job.failures += 1
+                    job.last_error = str(failure)
+                    if job.failed:
+                        self.log('Giving up on %s job %s (%s)'
+                            % (job.kind, job.id, job.name))
+                        job = job.scrubbed()
+                    queue.save(job)
+                else:
+                    completed += 1
+                    del job.tasks[i]
+                    if job.tasks:
+                        queue.save(job)
+                    else:
+                        finish(job)
+                        queue.remove(job.id)
+                        self.log('Finished %s job %s (%s)'
+                            % (job.kind, job.id, job.name))
+
+                sleeptime = random.randint(self.sleep_min, self.sleep_max)
+                if quick:
+                    sleeptime = 1
+        return completed
+
     def wanted_language(self):
         # FIXME: How do we know which language the user wants?
         #        This approach is useful for testing, but not much else.
         return os.getenv('PASSCROW_LANGUAGE', 'en')
 
-    def verify(self, pack, quick=False, now=None):
+    @_stepwise
+    def verify(self, pack, quick=False, now=None, mode=None,
+            quorum=False, prefer_fast=False):
+        """
+        Ask the escrow servers to send out verification codes. In quorum
+        mode, only as many servers are contacted as are needed to recover
+        the pack (more if some fail), and prefer_fast selects the servers
+        which have been the quickest to respond.
+        """
         ok, failures = True, []
         responses = {}
         def prep(prefix_esc, delay):
@@ -706,14 +1687,17 @@ class PasscrowClient:
                 % (delay, _id, esc.server, pack.name))
             return esc.server, vreq, _id
         def post(prefix_esc, server, vreq, resp, _id):
-            responses[prefix_esc[0]] = VerificationResponse(resp)
+            responses[prefix_esc[0]] = VerificationResponse.from_json(resp)
         def fmt_fail(prefix_esc, server, vreq, _id, e):
             return '%s on %s: %s' % (_id, server, e)
 
         tasks = pack.prefixed_escrow_list()
         task_dict = dict(tasks)
-        self._rpc_task_loop(
-            tasks, prep, post, fmt_fail, failures, quick)
+        if prefer_fast:
+            tasks = self._by_latency(tasks, lambda t: t[1].server)
+        yield _io('_rpc_task_loop',
+            tasks, prep, post, fmt_fail, failures, quick, mode=mode,
+            quorum=(pack.min_shares if quorum else None))
 
         if len(responses) >= pack.min_shares:
             def _info(pfx):
@@ -724,7 +1708,14 @@ class PasscrowClient:
         else:
             return None
 
-    def recover(self, pack, codes, quick=False):
+    @_stepwise
+    def recover(self, pack, codes, quick=False, mode=None,
+            quorum=False, prefer_fast=False):
+        """
+        Recover a secret using verification codes. In quorum mode we stop
+        as soon as enough shares have been collected; in the parallel
+        modes all codes are sent at once and the fastest servers win.
+        """
         ok, failures = True, []
         shares = []
         def prep(vcode_esc, delay):
@@ -737,7 +1728,7 @@ class PasscrowClient:
                 % (delay, _id, esc.server, rreq.verification, pack.name))
             return esc.server, rreq, _id
         def post(vcode_esc, server, vreq, resp, _id):
-            response = RecoveryResponse(resp)
+            response = RecoveryResponse.from_json(resp)
             shares.append(response.escrow_secret)
         def fmt_fail(prefix_esc, server, vreq, _id, e):
             return '%s on %s: %s' % (_id, server, e)
@@ -750,19 +1741,26 @@ class PasscrowClient:
         tasks = [(codes[c], esc)
             for c, esc in pack.prefixed_escrow_list()
             if c in codes]
-        self._rpc_task_loop(
-            tasks, prep, post, fmt_fail, failures, quick)
+        if prefer_fast:
+            tasks = self._by_latency(tasks, lambda t: t[1].server)
+        yield _io('_rpc_task_loop',
+            tasks, prep, post, fmt_fail, failures, quick, mode=mode,
+            quorum=(pack.min_shares if quorum else None),
+            spare=len(tasks))
 
         if len(shares) >= pack.min_shares:
             if (shares[0] == shares[-1]) and 'is-ephemeral' in pack:
                 ep = RecoveryPack()
-                ep.decrypt_ephemeral(pack.name, shares[0])
+                try:
+                    ep.decrypt_ephemeral(pack.name, shares[0])
+                finally:
+                    forget_ephemeral_keys()
                 # Write ephemeral recovery pack to local database
-                ep.save(self._packfilename(ep.name))
+                self._save_pack(ep.name, ep)
                 return ep
 
             shares.extend(pack.shares)
-            aes_key = aesgcm_key_from_int(recover_secret(shares))
+            aes_key = aesgcm_key_from_int(recover_secret(shares), 256 // 8)
 
             eb = EncryptedBlob()
             eb.encrypted_data = pack.secret
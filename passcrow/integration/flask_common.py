@@ -10,20 +10,23 @@ def route_passcrow_api(app, server):
             info['user'] = request.remote_user
         return ', '.join('%s=%s' % (k, v) for k, v in info.items())
 
+    def handle(rpc_method, rdata):
+        ctype, body = server.handle_encoded(
+            user_info(), rpc_method, rdata, request.content_type)
+        status, headers = server.cache_headers(
+            rpc_method, body, request.headers.get('If-None-Match'))
+        if status == 304:
+            return Response(status=304, headers=headers)
+        return Response(body, content_type=ctype, headers=headers)
+
     def passcrow_stats():
-        return Response(
-            str(server.handle(user_info(), 'stats', request.data or '{}')),
-            content_type="application/json")
+        return handle('stats', request.data or '{}')
 
     def passcrow_policy():
-        return Response(
-            str(server.handle(user_info(), 'policy', request.data or '{}')),
-            content_type="application/json")
+        return handle('policy', request.data or '{}')
 
     def passcrow_api(rpc_method):
-        return Response(
-            str(server.handle(user_info(), rpc_method, request.data)),
-            content_type="application/json")
+        return handle(rpc_method, request.data)
 
     app.route('/passcrow/stats', methods=['GET', 'POST'])(passcrow_stats)
     app.route('/passcrow/policy', methods=['GET', 'POST'])(passcrow_policy)
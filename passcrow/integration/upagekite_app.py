@@ -3,6 +3,8 @@ from upagekite.httpd import HTTPD, url
 from upagekite.proto import uPageKiteDefaults, Kite
 from upagekite.web import process_post
 
+from .. import cbor
+
 
 global PC_SERVER
 
@@ -18,10 +20,22 @@ def passcrow_api(req_env):
             and req_env.http_method != 'POST'):
         return {'code': 400, 'msg': 'Forbidden', 'body': 'Forbidden'}
 
-    resp = PC_SERVER.handle(user_info(req_env), rpc_method, req_env.post_data)
+    # JSON is parsed for us by uPageKite, binary data is left as-is.
+    ctype = req_env.http_headers.get('Content-Type')
+    if (ctype or '').startswith(cbor.CONTENT_TYPE):
+        rdata = req_env['frame'].payload
+    else:
+        rdata = req_env.post_data
+    mimetype, body = PC_SERVER.handle_encoded(
+        user_info(req_env), rpc_method, rdata, ctype)
+    status, headers = PC_SERVER.cache_headers(
+        rpc_method, body, req_env.http_headers.get('If-None-Match'))
+    if status == 304:
+        return {'code': 304, 'msg': 'Not Modified', 'hdrs': headers, 'body': ''}
     return {
-        'mimetype': "application/json",
-        'body': str(resp)}
+        'mimetype': mimetype,
+        'hdrs': headers,
+        'body': body}
 
 
 def run_server(server, kite_name, kite_secret):
@@ -0,0 +1,113 @@
+"""Passcrow client job queue
+
+Escrow operations can take a long time: for anonymity, the client sleeps
+for a random while (up to many minutes) between requests to different
+servers. Rather than block, the client can queue the work as a job in
+the data directory, to be carried out by a `passcrow worker` process.
+
+Each job is stored as a file of its own and rewritten after every task
+which completes, so a worker which is killed loses at most the task it
+was working on; which will then be retried. Only one worker may drain
+the queue at a time, which is enforced using a lock file.
+
+Jobs are carried out unattended, so they hold everything needed to do
+so, secrets included. Job files are only readable by their owner.
+"""
+import contextlib
+import json
+import os
+import time
+
+
+DEFAULT_LOCK_STALE_SECONDS = 3600
+
+
+def new_job_id():
+    return os.urandom(8).hex()
+
+
+class JobQueue:
+    DIRNAME = 'jobs'
+    SUFFIX = '.job'
+    LOCKFILE = 'worker.lock'
+
+    def __init__(self, data_dir, load_job):
+        """
+        The `load_job` function converts parsed JSON back into a job
+        object; jobs must have an `id` and a `created_ts`, and str(job)
+        must serialize them as JSON.
+        """
+        self.path = os.path.join(os.fsdecode(data_dir), self.DIRNAME)
+        self.load_job = load_job
+
+    def _job_path(self, job_id):
+        if not job_id or not all(c in '0123456789abcdef' for c in job_id):
+            raise KeyError('Invalid job ID: %s' % job_id)
+        return os.path.join(self.path, job_id + self.SUFFIX)
+
+    def save(self, job):
+        if not os.path.exists(self.path):
+            os.mkdir(self.path, 0o700)
+        path = self._job_path(job.id)
+        tmp = path + '.tmp'
+        # Jobs may hold recovery packs under construction; keep them private.
+        fd = os.open(tmp, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, 0o600)
+        with open(fd, 'w') as fd:
+            fd.write(str(job))
+        os.replace(tmp, path)
+        return job.id
+
+    def remove(self, job_id):
+        try:
+            os.remove(self._job_path(job_id))
+        except FileNotFoundError:
+            pass
+
+    def get(self, job_id):
+        """Load a job, returning None if it does not (or no longer) exists."""
+        try:
+            with open(self._job_path(job_id), 'r') as fd:
+                return self.load_job(json.load(fd))
+        except FileNotFoundError:
+            return None
+
+    def jobs(self):
+        """All queued jobs, oldest first."""
+        jobs = []
+        if os.path.exists(self.path):
+            for fn in os.listdir(self.path):
+                if fn.endswith(self.SUFFIX):
+                    job = self.get(fn[:-len(self.SUFFIX)])
+                    if job is not None:
+                        jobs.append(job)
+        jobs.sort(key=lambda j: (j.created_ts, j.id))
+        return jobs
+
+    def touch_lock(self):
+        os.utime(os.path.join(self.path, self.LOCKFILE))
+
+    @contextlib.contextmanager
+    def lock(self, stale_after=DEFAULT_LOCK_STALE_SECONDS):
+        """
+        Take the worker lock, raising an IOError if another worker holds
+        it. Workers should call touch_lock() regularly; locks which have
+        not been touched in `stale_after` seconds are assumed abandoned.
+        """
+        if not os.path.exists(self.path):
+            os.mkdir(self.path, 0o700)
+        lockfile = os.path.join(self.path, self.LOCKFILE)
+        try:
+            if time.time() - os.path.getmtime(lockfile) > stale_after:
+                os.remove(lockfile)
+        except FileNotFoundError:
+            pass
+        try:
+            fd = os.open(lockfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+        except FileExistsError:
+            raise IOError('Another worker is running (%s)' % lockfile)
+        try:
+            os.write(fd, b'%d\n' % os.getpid())
+            os.close(fd)
+            yield self
+        finally:
+            os.remove(lockfile)
@@ -1,10 +1,11 @@
-import io
+import asyncio
 import json
 import sys
 import tempfile
 import time
 
 from .server import PasscrowServer, FileSystemStorage
+from .transport import HTTPResponse
 from .handlers.email import make_email_hint
 
 
@@ -24,6 +25,10 @@ def sleep_func(sleeptime):
     time.sleep(1)
 
 
+async def async_sleep_func(sleeptime):
+    await asyncio.sleep(1)
+
+
 def prepare_mock_server(data_dir):
     global MOCK_SERVER
     if not data_dir:
@@ -38,12 +43,28 @@ def prepare_mock_server(data_dir):
             'sms': mock_handler})
 
 
-def urlopen_func(url, data=None, **kwargs):
+def urlopen_func(url, data=None, headers={}, **kwargs):
     global MOCK_SERVER
     rpc_method = url.rstrip('/').split('/')[-1]
 
-    sys.stderr.write('%s <- %s\n' % (url, str(data, 'utf-8')))
-    result = str(MOCK_SERVER.handle('mock', rpc_method, data))
-    sys.stderr.write('%s -> %s\n' % (url, result))
+    def _fmt(data):
+        try:
+            return str(data, 'utf-8')
+        except UnicodeDecodeError:
+            return repr(data)
+
+    sys.stderr.write('%s <- %s\n' % (url, _fmt(data)))
+    ctype, result = MOCK_SERVER.handle_encoded(
+        'mock', rpc_method, data, headers.get('Content-type'))
+    status, hdrs = MOCK_SERVER.cache_headers(
+        rpc_method, result, headers.get('If-None-Match'))
+    if status == 304:
+        result = b''
+    sys.stderr.write('%s -> %d %s\n' % (url, status, _fmt(result)))
+
+    hdrs['Content-Type'] = ctype
+    return HTTPResponse(status, 'OK', hdrs, result)
+
 
-    return io.StringIO(result)
+async def async_urlopen_func(url, data=None, headers={}, **kwargs):
+    return urlopen_func(url, data=data, headers=headers, **kwargs)
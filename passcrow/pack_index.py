@@ -0,0 +1,177 @@
+"""Passcrow recovery pack index
+
+Listing recovery packs used to mean parsing every pack file in the data
+directory. This module maintains a compact index of the metadata needed
+for listing and lookups (name, timestamps, kinds and servers), stored
+alongside the packs.
+
+The client updates the index whenever it saves or deletes a pack. The
+index is validated against the directory contents (file sizes and
+modification times) before use, so packs added, changed or removed
+behind our back are noticed and only those files get re-read.
+"""
+import datetime
+import json
+import os
+import threading
+
+
+class PackInfo:
+    __slots__ = ('name', 'created_ts', 'expires_ts', 'kinds', 'servers',
+        'is_ephemeral')
+
+    def __init__(self, name, created_ts=0, expires_ts=None,
+            kinds=(), servers=(), is_ephemeral=False):
+        self.name = name
+        self.created_ts = created_ts
+        self.expires_ts = expires_ts
+        self.kinds = list(kinds)
+        self.servers = list(servers)
+        self.is_ephemeral = is_ephemeral
+
+    created = property(
+        lambda s: datetime.datetime.fromtimestamp(s.created_ts))
+
+    # Packs without escrow (ephemeral packs) never expire; for those,
+    # expires_ts and expires are None.
+    expires = property(
+        lambda s: None if (s.expires_ts is None)
+            else datetime.datetime.fromtimestamp(s.expires_ts))
+
+    @classmethod
+    def FromPack(cls, name, pack):
+        escrow = pack.escrow if ('escrow' in pack) else []
+        return cls(name,
+            created_ts=int(pack.created_ts) if ('created-ts' in pack) else 0,
+            expires_ts=min(
+                [e.response.expiration for e in escrow], default=None),
+            kinds=sorted(set(e.kind for e in escrow)),
+            servers=sorted(set(e.server for e in escrow)),
+            is_ephemeral=bool('is-ephemeral' in pack and pack.is_ephemeral))
+
+    def to_json(self):
+        return [self.name, self.created_ts, self.expires_ts,
+            self.kinds, self.servers, self.is_ephemeral]
+
+    def __repr__(self):
+        return '<PackInfo(%s)>' % ', '.join(repr(v) for v in self.to_json())
+
+
+class PackIndex:
+    FILENAME = 'pack_index.json'
+    VERSION = 2
+
+    def __init__(self, data_dir, suffix, name_of, load_pack):
+        """
+        The `name_of` function maps pack file names to pack names, and
+        `load_pack` loads a RecoveryPack from a path.
+        """
+        self.data_dir = os.fsdecode(data_dir)
+        self.suffix = os.fsdecode(suffix)
+        self.name_of = name_of
+        self.load_pack = load_pack
+        self.path = os.path.join(self.data_dir, self.FILENAME)
+        self.lock = threading.RLock()
+        self.entries = None  # filename -> (stat key, PackInfo)
+        self.validated = False
+
+    def _stat_key(self, st):
+        return [st.st_mtime_ns, st.st_size]
+
+    def _load(self):
+        self.entries = {}
+        try:
+            with open(self.path, 'r') as fd:
+                data = json.load(fd)
+            if data.get('version') == self.VERSION:
+                for fn, (key, info) in data['packs'].items():
+                    self.entries[fn] = (key, PackInfo(*info))
+        except (OSError, IOError, ValueError, TypeError, KeyError):
+            self.entries = {}
+
+    def _save(self):
+        try:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as fd:
+                json.dump({
+                        'version': self.VERSION,
+                        'packs': dict(
+                            (fn, (key, info.to_json()))
+                            for fn, (key, info) in self.entries.items())},
+                    fd, separators=(',', ':'))
+            os.replace(tmp, self.path)
+        except (OSError, IOError):
+            pass
+
+    def _describe(self, fn):
+        path = os.path.join(self.data_dir, fn)
+        st = os.stat(path)
+        name = self.name_of(fn)
+        return (self._stat_key(st), PackInfo.FromPack(name, self.load_pack(path)))
+
+    def refresh(self):
+        """
+        Bring the index up to date with the data directory, re-reading
+        only the pack files which are new or have changed.
+        """
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            changed = False
+            seen = set()
+            for entry in os.scandir(self.data_dir):
+                fn = entry.name
+                if not fn.endswith(self.suffix):
+                    continue
+                seen.add(fn)
+                try:
+                    key = self._stat_key(entry.stat())
+                    if fn not in self.entries or self.entries[fn][0] != key:
+                        self.entries[fn] = self._describe(fn)
+                        changed = True
+                except (OSError, IOError, ValueError, KeyError):
+                    if self.entries.pop(fn, None) is not None:
+                        changed = True
+            for fn in [fn for fn in self.entries if fn not in seen]:
+                del self.entries[fn]
+                changed = True
+            if changed:
+                self._save()
+            self.validated = True
+        return self
+
+    def update(self, path, pack):
+        """Record the metadata of a pack which has just been saved."""
+        fn = os.path.basename(os.fsdecode(path))
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            try:
+                self.entries[fn] = (
+                    self._stat_key(os.stat(path)),
+                    PackInfo.FromPack(self.name_of(fn), pack))
+            except (OSError, IOError):
+                self.entries.pop(fn, None)
+            self._save()
+
+    def remove(self, path):
+        fn = os.path.basename(os.fsdecode(path))
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            if self.entries.pop(fn, None) is not None:
+                self._save()
+
+    def packs(self):
+        """All indexed packs, validated against the directory first."""
+        with self.lock:
+            if not self.validated:
+                self.refresh()
+            return [info for key, info in self.entries.values()]
+
+    def find(self, server=None, kind=None, expires_before=None):
+        return [info for info in self.packs()
+            if (server is None or server in info.servers)
+            and (kind is None or kind in info.kinds)
+            and (expires_before is None or (info.expires_ts is not None
+                and info.expires_ts < expires_before))]
@@ -1,8 +1,15 @@
+import hashlib
+import hmac
+import json
+import math
+import multiprocessing
+import os
+import queue
+import threading
 import time
 
 from .proto import PaymentScheme
 
-from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 
 from .aes_utils import aesgcm_key_to_int, aesgcm_key_from_int
@@ -17,9 +24,168 @@ def register_payment_handlers(*classes):
         PAYMENT_HANDLERS[cls.SCHEME] = cls
 
 
-def make_payment(policy, data):
+def make_payment(policy, data, wallet=None):
     global PAYMENT_HANDLERS
-    return PAYMENT_HANDLERS[policy.scheme].MakePayment(policy, data)
+    handler = PAYMENT_HANDLERS[policy.scheme]
+    if getattr(handler, 'PREPAID', False):
+        return handler.MakePayment(policy, data, wallet=wallet)
+    return handler.MakePayment(policy, data)
+
+
+def can_pay(policy, wallet=None):
+    """Check whether we can make payments according to a given policy."""
+    handler = PAYMENT_HANDLERS.get(policy.scheme)
+    if handler is None:
+        return False
+    if getattr(handler, 'PREPAID', False):
+        return handler.CanPay(policy, wallet=wallet)
+    return handler.CanPay(policy)
+
+
+def is_prepaid(policy):
+    handler = PAYMENT_HANDLERS.get(policy.scheme)
+    return getattr(handler, 'PREPAID', False)
+
+
+def rank_payment_schemes(schemes, wallet=None):
+    """
+    Returns the schemes we can pay, in order of preference: prepaid
+    schemes (vouchers) first, since they are cheaper for everyone than
+    minting hashcash, then those with the shortest (cheapest) expiration.
+    """
+    return sorted((p for p in schemes if can_pay(p, wallet)),
+        key=lambda p: (not is_prepaid(p), p.expiration_seconds))
+
+
+def _mint_worker(cls, bitmask, data, first, step, deadline, stop, results):
+    found = cls._mint(bitmask, data, first, step, deadline, stop=stop)
+    if found:
+        results.put(found)
+        stop.set()
+
+
+def _scrypt_rate_worker(cls, data, seconds, results):
+    results.put(cls._scrypt_rate(data, seconds))
+
+
+class SpentTokens:
+    """
+    A record of recently spent payment tokens, used to prevent replays.
+
+    Tokens are only valid for a short window after they are minted, so
+    we only need to remember them that long. Tokens are partitioned into
+    per-minute buckets by their timestamp, and whole buckets are dropped
+    once they fall out of the validity window. This keeps both memory use
+    and lookups bounded, no matter how many payments we process.
+
+    If a storage object is provided, spent tokens are recorded there
+    instead of in RAM, which allows multiple server processes to share
+    the same record.
+    """
+    TABLE = 'spent'
+
+    def __init__(self, window, storage=None):
+        self.window = window
+        self.storage = storage
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def _expire(self, now):
+        oldest = (now - self.window) // 60
+        for minute in [m for m in self.buckets if m < oldest]:
+            del self.buckets[minute]
+
+    def spend(self, token_id, ts, now=None):
+        """Mark a token as spent. Returns False if it already was."""
+        now = int(now or time.time())
+        if self.storage is not None:
+            # The marker is created atomically, so concurrent server
+            # processes cannot both accept the same token.
+            try:
+                self.storage.insert(self.TABLE, b'spent',
+                    row_id=token_id,
+                    expiration=(ts + self.window + 60),
+                    exclusive=True)
+                return True
+            except FileExistsError:
+                return False
+        with self.lock:
+            self._expire(now)
+            bucket = self.buckets.get(ts // 60)
+            if bucket is None:
+                bucket = self.buckets[ts // 60] = set()
+            elif token_id in bucket:
+                return False
+            bucket.add(token_id)
+            return True
+
+    def is_spent(self, token_id, ts):
+        if self.storage is not None:
+            try:
+                self.storage.fetch(self.TABLE, '0-%s' % token_id)
+                return True
+            except KeyError:
+                return False
+        return (token_id in self.buckets.get(ts // 60, ()))
+
+
+class PaymentLoad:
+    """
+    Tracks the recent rate of escrow requests, for load-adaptive hashcash.
+
+    The rate is an exponentially decaying average (time constant `tau`
+    seconds). For every doubling of the rate above `baseline` requests
+    per second, one extra bit of hashcash is demanded, up to a maximum
+    of `max_extra_bits`.
+
+    Since clients may have fetched our policy a while ago, we remember
+    which levels were advertised during the last `grace` seconds and
+    accept payments made against the lowest of them.
+    """
+    def __init__(self, baseline=0.2, tau=300, max_extra_bits=6, grace=300):
+        self.baseline = baseline
+        self.tau = tau
+        self.max_extra_bits = max_extra_bits
+        self.grace = grace
+        self.rate = 0.0
+        self.last_ts = time.time()
+        self.history = []  # (timestamp, extra_bits) tuples
+        self.lock = threading.Lock()
+
+    def _decay(self, now):
+        if now > self.last_ts:
+            self.rate *= math.exp(-(now - self.last_ts) / self.tau)
+            self.last_ts = now
+
+    def tick(self, now=None):
+        """Record an escrow request."""
+        with self.lock:
+            self._decay(now or time.time())
+            self.rate += 1.0 / self.tau
+
+    def extra_bits(self, now=None):
+        """Calculate (and remember) how many extra bits we want now."""
+        now = now or time.time()
+        with self.lock:
+            self._decay(now)
+            extra = 0
+            if self.rate > self.baseline:
+                extra = min(self.max_extra_bits,
+                    1 + int(math.log(self.rate / self.baseline, 2)))
+            if not self.history or self.history[-1][1] != extra:
+                self.history.append((now, extra))
+            return extra
+
+    def min_extra_bits(self, now=None):
+        """The lowest number of extra bits advertised in the grace period."""
+        now = now or time.time()
+        current = self.extra_bits(now)
+        with self.lock:
+            # Keep the newest change older than the grace period, since it
+            # was still in effect when the grace period began.
+            while len(self.history) > 1 and self.history[1][0] < now - self.grace:
+                self.history.pop(0)
+            return min([current] + [e for t, e in self.history])
 
 
 class PaymentFree:
@@ -41,6 +207,10 @@ class PaymentFree:
     def MakePayment(self, policy, data):
         return '%s:0' % policy.scheme_id
 
+    @classmethod
+    def CanPay(cls, policy):
+        return True
+
     def get_policy(self, user_auth_FIXME):
         return self.policy
 
@@ -56,56 +226,167 @@ class PaymentHashcash(PaymentFree):
     SCRYPT_R = 8
     SCRYPT_P = 1
 
-    def __init__(self, storage, bits, value):
+    # Collisions are only valid for 2 minutes, with a minor allowance
+    # for clocks being out of sync.
+    MAX_AGE = 125
+    MAX_SKEW = 5
+
+    # Minting is spread over this many processes (None: one per core),
+    # but only if the expected work is large enough to be worth the cost
+    # of starting them. Worker processes are not forked, since the client
+    # may well be minting from a background thread.
+    MINT_WORKERS = None
+    MINT_PARALLEL_BITS = 9
+    MINT_START_METHOD = (
+        'forkserver'
+        if 'forkserver' in multiprocessing.get_all_start_methods()
+        else 'spawn')
+
+    def __init__(self, storage, bits, value, spent=None, load=None):
         PaymentFree.__init__(self, value)
 
         self.storage = storage
+        self.spent = spent or self.MakeSpentTokens()
+        self.load = load
 
         self.policy.hashcash_bits = bits
         self.policy.scheme_id = '%s-%d' % (self.SCHEME, bits)
-        self.policy.description = (
-            '%d-bit scrypt(len=%d,n=%d,r=%d,p=%d) collisions' % (
-                bits,
-                self.SCRYPT_LENGTH,
-                self.SCRYPT_N, self.SCRYPT_R, self.SCRYPT_P))
+        self.policy.description = self._describe(bits)
 
         self.bits = bits
         self.bitmask = self._bitmask(self.policy)
+        self.adaptive_policies = {0: self.policy}
+
+    def _describe(self, bits):
+        return '%d-bit scrypt(len=%d,n=%d,r=%d,p=%d) collisions' % (
+            bits,
+            self.SCRYPT_LENGTH,
+            self.SCRYPT_N, self.SCRYPT_R, self.SCRYPT_P)
+
+    def get_policy(self, user_auth_FIXME):
+        if self.load is None:
+            return self.policy
+
+        # Note: The scheme-id stays the same as the difficulty varies, so
+        # clients paying against an older policy still reach this object.
+        extra = self.load.extra_bits()
+        if extra not in self.adaptive_policies:
+            policy = PaymentScheme(self.policy._dict)
+            policy.hashcash_bits = self.bits + extra
+            policy.description = self._describe(self.bits + extra)
+            self.adaptive_policies[extra] = policy
+        return self.adaptive_policies[extra]
+
+    @classmethod
+    def MakeSpentTokens(cls, storage=None):
+        """
+        Create a record of spent tokens suitable for this scheme. Share one
+        across all tiers, so a collision cannot be spent once per tier.
+        """
+        return SpentTokens(cls.MAX_AGE + cls.MAX_SKEW, storage=storage)
 
     @classmethod
     def _bitmask(cls, policy):
-        bitmask = 0
-        for i in range(0, policy.hashcash_bits):
-            bitmask *= 2
-            bitmask |= 1
-        return bitmask
+        return (1 << policy.hashcash_bits) - 1
 
     @classmethod
     def _scrypt(cls, counter, ts, data):
-        kdf = Scrypt(
+        return Scrypt(
             salt=b'',
             length=cls.SCRYPT_LENGTH,
             n=cls.SCRYPT_N,
             r=cls.SCRYPT_R,
-            p=cls.SCRYPT_P,
-            backend=default_backend())
-        return kdf.derive(b''.join([data, b'%x' % counter, b'%x' % ts, data]))
+            p=cls.SCRYPT_P
+            ).derive(b''.join([data, b'%x' % counter, b'%x' % ts, data]))
 
     @classmethod
-    def MakePayment(cls, policy, data, maxtime=90):
-        data = data if isinstance(data, bytes) else bytes(data, 'utf-8')
-        bitmask = cls._bitmask(policy)
+    def _mint(cls, bitmask, data, first, step, deadline, stop=None):
+        """
+        Search the counters first, first+step, first+2*step, ... for a
+        collision, until the deadline passes or `stop` is set. Returns a
+        (counter, timestamp) tuple, or None if nothing was found.
+        """
+        scrypt, to_int = cls._scrypt, aesgcm_key_to_int
+        counter = first
         now = int(time.time())
-        deadline = now + maxtime
-        counter = 0
         while now < deadline:
-            counter += 1
-            scrypt_cnd = aesgcm_key_to_int(cls._scrypt(counter, now, data))
-            if (scrypt_cnd & bitmask) == 0:
-                return '%s:%x-%x' % (policy.scheme_id, counter, now)
+            if (to_int(scrypt(counter, now, data)) & bitmask) == 0:
+                return (counter, now)
+            if stop is not None and stop.is_set():
+                return None
+            counter += step
             now = int(time.time())
+        return None
+
+    @classmethod
+    def _parallel_mint(cls, bitmask, data, deadline, workers):
+        ctx = multiprocessing.get_context(cls.MINT_START_METHOD)
+        stop, results = ctx.Event(), ctx.Queue()
+        procs = [
+            ctx.Process(
+                target=_mint_worker,
+                args=(cls, bitmask, data, i+1, workers, deadline, stop, results),
+                daemon=True)
+            for i in range(0, workers)]
+        for proc in procs:
+            proc.start()
+        try:
+            return results.get(timeout=max(0, deadline - time.time()) + 1)
+        except queue.Empty:
+            return None
+        finally:
+            stop.set()
+            for proc in procs:
+                proc.join(1)
+                if proc.is_alive():
+                    proc.terminate()
+
+    @classmethod
+    def MakePayment(cls, policy, data, maxtime=90, workers=None):
+        data = data if isinstance(data, bytes) else bytes(data, 'utf-8')
+        bitmask = cls._bitmask(policy)
+        deadline = int(time.time()) + maxtime
+
+        workers = workers or cls.MINT_WORKERS or os.cpu_count() or 1
+        if workers > 1 and policy.hashcash_bits >= cls.MINT_PARALLEL_BITS:
+            found = cls._parallel_mint(bitmask, data, deadline, workers)
+        else:
+            found = cls._mint(bitmask, data, 1, 1, deadline)
+
+        if found:
+            return '%s:%x-%x' % ((policy.scheme_id,) + found)
         raise ValueError('HashCash not found after %d seconds' % maxtime)
 
+    @classmethod
+    def _scrypt_rate(cls, data, seconds):
+        count, ts = 0, int(time.time())
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            count += 1
+            cls._scrypt(count, ts, data)
+        return count / seconds
+
+    @classmethod
+    def MeasureMintRate(cls, data, seconds=2.0, workers=1):
+        """Measure aggregate scrypt attempts/second using N processes."""
+        if workers < 2:
+            return cls._scrypt_rate(data, seconds)
+        ctx = multiprocessing.get_context(cls.MINT_START_METHOD)
+        results = ctx.Queue()
+        procs = [
+            ctx.Process(
+                target=_scrypt_rate_worker,
+                args=(cls, data, seconds, results),
+                daemon=True)
+            for i in range(0, workers)]
+        for proc in procs:
+            proc.start()
+        try:
+            return sum(results.get(timeout=seconds + 30) for p in procs)
+        finally:
+            for proc in procs:
+                proc.join(1)
+
     def process(self, cash, data, now=None):
         now = int(now or time.time())
         data = data if isinstance(data, bytes) else bytes(data, 'utf-8')
@@ -113,23 +394,283 @@ class PaymentHashcash(PaymentFree):
         counter = int(counter, 16)
         ts = int(ts, 16)
 
-        # Collisions are only valid for 2 minutes, with a minor allowance
-        # for clocks being out of sync.
-        if not (now-125 < ts < now+5):
+        if not (now-self.MAX_AGE < ts < now+self.MAX_SKEW):
             return 0
 
+        # Each collision may only be spent once; check before doing the
+        # expensive scrypt, but only record it once we know it is valid.
+        token_id = hashlib.sha256(
+            b''.join([b'%x-%x:' % (counter, ts), data])).hexdigest()[:32]
+        if self.spent.is_spent(token_id, ts):
+            return 0
+
+        bitmask = self.bitmask
+        if self.load is not None:
+            bitmask = (1 << (self.bits + self.load.min_extra_bits(now))) - 1
+
         scrypt_ctd = aesgcm_key_to_int(self._scrypt(counter, ts, data))
-        if (scrypt_ctd & self.bitmask) == 0:
-            return self.value
-        else:
+        if (scrypt_ctd & bitmask) == 0:
+            if self.spent.spend(token_id, ts, now=now):
+                return self.value
+        return 0
+
+
+class VoucherWallet:
+    """
+    The prepaid vouchers held by a client, by payment scheme-id, stored
+    as JSON in a file (or only in RAM, if no path is given).
+
+    Making a payment only reserves a voucher. Once the server has
+    answered, the client settles the payment: vouchers which were
+    accepted (or rejected) are removed from the wallet, while vouchers
+    from requests which failed for other reasons are released for reuse.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.vouchers = {}
+        self.reserved = set()
+        self.lock = threading.Lock()
+
+    def _load(self):
+        if self.path:
+            try:
+                with open(self.path, 'r') as fd:
+                    self.vouchers = json.load(fd)
+            except FileNotFoundError:
+                self.vouchers = {}
+        return self.vouchers
+
+    def _save(self):
+        if self.path:
+            tmp = self.path + '.tmp'
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as fd:
+                json.dump(self.vouchers, fd, indent=1)
+            os.replace(tmp, self.path)
+
+    def add(self, scheme_id, vouchers):
+        with self.lock:
+            wallet = self._load().setdefault(scheme_id, [])
+            wallet.extend(v for v in vouchers if v not in wallet)
+            self._save()
+
+    def count(self, scheme_id):
+        with self.lock:
+            return len([v for v in self._load().get(scheme_id, [])
+                if v not in self.reserved])
+
+    def counts(self):
+        with self.lock:
+            return dict((sid, len(v)) for sid, v in self._load().items())
+
+    def reserve(self, scheme_id):
+        with self.lock:
+            for voucher in self._load().get(scheme_id, []):
+                if voucher not in self.reserved:
+                    self.reserved.add(voucher)
+                    return voucher
+        raise ValueError('No vouchers available for %s' % scheme_id)
+
+    def settle(self, payment, spent):
+        """Remove a reserved voucher if it was spent, else release it."""
+        scheme_id, voucher = payment.split(':', 1)
+        with self.lock:
+            self.reserved.discard(voucher)
+            if spent:
+                wallet = self._load().get(scheme_id, [])
+                if voucher in wallet:
+                    wallet.remove(voucher)
+                    if not wallet:
+                        del self.vouchers[scheme_id]
+                    self._save()
+
+
+class PaymentVoucher(PaymentFree):
+    """
+    Prepaid vouchers, issued by the server out of band (e.g. sold in bulk
+    to an integrator) and redeemed by clients, one per escrow request.
+
+    Vouchers are HMAC-signed by the server, so verifying one costs a
+    single HMAC and a storage lookup to make sure it was not already
+    redeemed, instead of an scrypt.
+
+    A voucher looks like `<expiration>-<id>.<mac>`, all in hex.
+    """
+    SCHEME = 'voucher'
+    PREPAID = True
+    TABLE = 'vouchers'
+    ID_BYTES = 16
+    MAC_BYTES = 16
+    DEFAULT_LIFETIME = 2 * 366 * 24 * 3600
+
+    def __init__(self, secret, value, storage=None, scheme_id=None):
+        PaymentFree.__init__(self, value)
+        self.secret = secret if isinstance(secret, bytes) else bytes(secret, 'utf-8')
+        self.storage = storage
+
+        # Derive a default scheme-id from the secret, so clients holding
+        # vouchers for multiple servers can tell them apart.
+        self.policy.scheme_id = scheme_id or '%s-%s' % (self.SCHEME,
+            hashlib.sha256(b'Passcrow voucher:' + self.secret).hexdigest()[:8])
+        self.policy.description = 'Prepaid vouchers'
+
+    def _mac(self, body):
+        return hmac.new(self.secret,
+            bytes('%s:%s' % (self.scheme_id, body), 'latin-1'),
+            hashlib.sha256).hexdigest()[:2*self.MAC_BYTES]
+
+    def issue(self, count=1, lifetime=DEFAULT_LIFETIME, now=None):
+        """Generate `count` new vouchers, valid for `lifetime` seconds."""
+        expiration = int(now or time.time()) + lifetime
+        vouchers = []
+        for i in range(0, count):
+            body = '%x-%s' % (expiration, os.urandom(self.ID_BYTES).hex())
+            vouchers.append('%s.%s' % (body, self._mac(body)))
+        return vouchers
+
+    @classmethod
+    def CanPay(cls, policy, wallet=None):
+        return (wallet is not None) and (wallet.count(policy.scheme_id) > 0)
+
+    @classmethod
+    def MakePayment(cls, policy, data, wallet=None):
+        """
+        Reserve a voucher from the wallet; the caller must settle() the
+        payment with the wallet once the server has responded.
+        """
+        if wallet is None:
+            raise ValueError('No vouchers available for %s' % policy.scheme_id)
+        return '%s:%s' % (policy.scheme_id, wallet.reserve(policy.scheme_id))
+
+    def process(self, cash, data, now=None):
+        now = int(now or time.time())
+        body, mac = cash.split('.')
+        expiration, voucher_id = body.split('-')
+        expiration = int(expiration, 16)
+        if (expiration < now
+                or len(voucher_id) != 2*self.ID_BYTES
+                or not hmac.compare_digest(mac, self._mac(body))):
             return 0
 
+        # The marker is created atomically, so each voucher can only be
+        # redeemed once, even with many server processes.
+        try:
+            self.storage.insert(self.TABLE, b'redeemed',
+                row_id=voucher_id, expiration=expiration, exclusive=True)
+        except FileExistsError:
+            return 0
+        return self.value
 
-register_payment_handlers(PaymentFree, PaymentHashcash)
+
+register_payment_handlers(PaymentFree, PaymentHashcash, PaymentVoucher)
+
+
+# Target client minting times (seconds) for each expiration tier.
+CALIBRATION_TIERS = [
+    (1,    183*24*3600),
+    (2,    366*24*3600),
+    (4,  2*366*24*3600),
+    (8,  5*366*24*3600),
+    (16, 10*366*24*3600)]
+
+
+def calibrate(seconds=2.0, tiers=CALIBRATION_TIERS, max_workers=None,
+        data=b'0123456789abcdef' * 64, log=None):
+    """
+    Measure how quickly this host can mint and verify hashcash, and
+    recommend (bits, expiration) tiers for the server's hashcash_params.
+
+    The tiers assume a client minting on a single core of a machine like
+    this one; clients with more cores will finish sooner.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    counts = [1]
+    while counts[-1] * 2 <= max_workers:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != max_workers:
+        counts.append(max_workers)
+
+    mint_rates = []
+    for workers in counts:
+        rate = PaymentHashcash.MeasureMintRate(data, seconds, workers)
+        mint_rates.append((workers, rate))
+        if log:
+            log('Minting with %d process(es): %.0f scrypt/s' % (workers, rate))
+
+    # Verification is one scrypt plus bookkeeping; time the real thing,
+    # with (almost certainly) worthless but otherwise acceptable tokens.
+    ph = PaymentHashcash(None, 64, 1)
+    ts, count = int(time.time()), 0
+    t0 = time.perf_counter()
+    while time.perf_counter() < t0 + seconds:
+        count += 1
+        ph.process('%x-%x' % (count, ts), data, now=ts)
+    verify_secs = (time.perf_counter() - t0) / count
+    if log:
+        log('Verifying: %.3f ms per payment' % (verify_secs * 1000))
+
+    single = mint_rates[0][1]
+    recommended = []
+    for target, expiration in tiers:
+        bits = max(1, int(round(math.log(single * target, 2))))
+        recommended.append((bits, expiration, (2**bits) / single))
+
+    return {
+        'cpus': os.cpu_count() or 1,
+        'mint_rates': mint_rates,
+        'verify_seconds': verify_secs,
+        'hashcash_params': recommended}
+
+
+def calibration_config(results):
+    """Format calibration results as a server_config.py snippet."""
+    cpus = results['cpus']
+    verify_ms = results['verify_seconds'] * 1000
+    lines = [
+        '# Hashcash calibration: %d CPU core(s)' % cpus,
+        '#']
+    for workers, rate in results['mint_rates']:
+        lines.append('#   Minting, %2d process(es): %8.0f scrypt/s'
+            % (workers, rate))
+    lines.extend([
+        '#   Verifying: %.3f ms of CPU per paid escrow request,' % verify_ms,
+        '#              or at most ~%d requests/s using all cores.'
+            % (cpus * 1000 / verify_ms),
+        '#',
+        'hashcash_params = ['])
+    tiers = results['hashcash_params']
+    for i, (bits, expiration, etd) in enumerate(tiers):
+        days = expiration // (24 * 3600)
+        tier = '(%d, %d*24*3600)%s' % (
+            bits, days, ']' if (i == len(tiers) - 1) else ',')
+        lines.append('    %-22s # Etd time: %.1fs' % (tier, etd))
+    return '\n'.join(lines)
 
 
 if __name__ == '__main__':
-    import time, math
+    import sys
+
+    if sys.argv[1:2] == ['calibrate']:
+        seconds = float(sys.argv[2]) if sys.argv[2:] else 2.0
+        results = calibrate(seconds=seconds,
+            log=lambda m: sys.stderr.write(m + '\n'))
+        print(calibration_config(results))
+        sys.exit(0)
+
+    # Schemes with equal expirations must not be compared to each other
+    expiration = 366 * 24 * 3600
+    voucher = PaymentVoucher(secret='testing', value=expiration)
+    wallet = VoucherWallet()
+    wallet.add(voucher.scheme_id, voucher.issue())
+    schemes = [
+        PaymentHashcash(None, 12, expiration).policy,
+        voucher.policy,
+        PaymentHashcash(None, 11, expiration // 2).policy,
+        PaymentFree(expiration).policy]
+    assert([p.scheme_id for p in rank_payment_schemes(schemes, wallet)] == [
+        voucher.scheme_id, 'hashcash-11', 'hashcash-12', 'free'])
+    assert(voucher.policy not in rank_payment_schemes(schemes))
+
     data = b'012345678' * 128
     stop = time.time() + 4
     counter = 0
@@ -141,4 +682,3 @@ if __name__ == '__main__':
     #       a collision should be found after checking half the space.
     print('%d iterations in %.1f seconds = %.2f bit collision?'
         % (counter, time.time() - stop + 1, math.log(counter, 2) + 1))
-
@@ -19,11 +19,12 @@ import re
 
 from .aes_utils import random_aesgcm_key
 from .util import _json_object, _encrypted_json_object
-from .util import _json_list, _json_object_prop
+from .util import _json_list
 
 
 PASSCROW_PROTO_VERSION = "1.0"
 PASSCROW_SUPPORTED_VERS = ("1.0",)
+PASSCROW_CBOR_VERSION = "1.0+cbor"  # Binary wire format, see cbor.py
 
 PASSCROW_ABOUT_URL = 'https://passcrow.mailpile.is/'
 
@@ -104,11 +105,6 @@ class EscrowRequestParameters(_encrypted_json_object):
         "prefer-id": str,
         "payment": str}
 
-    kind = property(*_json_object_prop('kind'))
-    expiration = property(*_json_object_prop('expiration'))
-    prefer_id = property(*_json_object_prop('prefer-id'))
-    payment = property(*_json_object_prop('payment'))
-
 
 class EscrowRequestData(_encrypted_json_object):
     """
@@ -129,12 +125,6 @@ class EscrowRequestData(_encrypted_json_object):
         "timeout": int,
         "notify": Identity}
 
-    description = property(*_json_object_prop('description'))
-    verify = property(*_json_object_prop('verify'))
-    notify = property(*_json_object_prop('notify'))
-    timeout = property(*_json_object_prop('timeout'))
-    secret = property(*_json_object_prop('secret'))
-
 
 class EscrowRequest(_json_object):
     _KEYS = {
@@ -142,11 +132,10 @@ class EscrowRequest(_json_object):
         "parameters-key": str,
         "parameters": str,
         "escrow-data": _json_list(str)}
-
-    passcrow_escrow_request = property(*_json_object_prop('passcrow-escrow-request'))
-    parameters_key = property(*_json_object_prop('parameters-key'))
-    parameters = property(*_json_object_prop('parameters'))
-    escrow_data = property(*_json_object_prop('escrow-data'))
+    _LIMITS = {
+        "passcrow-escrow-request": 16,
+        "parameters-key": 64,
+        "escrow-data": 4}
 
     def _set_defaults(self):
         self.passcrow_escrow_request = PASSCROW_PROTO_VERSION
@@ -179,11 +168,6 @@ class EscrowResponse(_json_object):
         "expiration": int,
         "error": str}
 
-    passcrow_escrow_response = property(*_json_object_prop('passcrow-escrow-response'))
-    escrow_data_id = property(*_json_object_prop('escrow-data-id'))
-    expiration = property(*_json_object_prop('expiration'))
-    error = property(*_json_object_prop('error'))
-
     def _set_defaults(self):
         self.passcrow_escrow_response = PASSCROW_PROTO_VERSION
 
@@ -201,12 +185,12 @@ class VerificationRequest(_json_object):
         "escrow-data-key": str,
         "language": str,
         "prefix": str}
-
-    passcrow_verification_request = property(*_json_object_prop('passcrow-verification-request'))
-    escrow_data_id = property(*_json_object_prop('escrow-data-id'))
-    escrow_data_key = property(*_json_object_prop('escrow-data-key'))
-    language = property(*_json_object_prop('language'))
-    prefix = property(*_json_object_prop('prefix'))
+    _LIMITS = {
+        "passcrow-verification-request": 16,
+        "escrow-data-id": 128,
+        "escrow-data-key": 64,
+        "language": 16,
+        "prefix": 1}
 
     def _set_defaults(self):
         self.passcrow_verification_request = PASSCROW_PROTO_VERSION
@@ -217,7 +201,6 @@ class VerificationRequest(_json_object):
             raise ValueError('Unsupported request version')
 
 
-
 class VerificationResponse(_json_object):
     """
     """
@@ -231,15 +214,6 @@ class VerificationResponse(_json_object):
         "prefix": str,     # Not used on the wire, internal only
         "error": str}
 
-    passcrow_verification_response = property(*_json_object_prop('passcrow-verification-response'))
-    hint = property(*_json_object_prop('hint'))
-    action_url = property(*_json_object_prop('action-url'))
-    escrow_data_id = property(*_json_object_prop('escrow-data-id'))
-    expiration = property(*_json_object_prop('expiration'))
-    kind = property(*_json_object_prop('kind'))
-    prefix = property(*_json_object_prop('prefix'))
-    error = property(*_json_object_prop('error'))
-
     def _set_defaults(self):
         self.passcrow_verification_response = PASSCROW_PROTO_VERSION
 
@@ -262,11 +236,11 @@ class RecoveryRequest(_json_object):
         "escrow-data-id": str,
         "escrow-data-key": str,
         "verification": str}
-
-    passcrow_recovery_request = property(*_json_object_prop('passcrow-recovery-request'))
-    escrow_data_id = property(*_json_object_prop('escrow-data-id'))
-    escrow_data_key = property(*_json_object_prop('escrow-data-key'))
-    verification = property(*_json_object_prop('verification'))
+    _LIMITS = {
+        "passcrow-recovery-request": 16,
+        "escrow-data-id": 128,
+        "escrow-data-key": 64,
+        "verification": 64}
 
     def _set_defaults(self):
         self.passcrow_recovery_request = PASSCROW_PROTO_VERSION
@@ -284,10 +258,6 @@ class RecoveryResponse(_json_object):
         "escrow-secret": str,
         "error": str}
 
-    passcrow_recovery_response = property(*_json_object_prop('passcrow-recovery-response'))
-    escrow_secret = property(*_json_object_prop('escrow-secret'))
-    error = property(*_json_object_prop('error'))
-
     def _set_defaults(self):
         self.passcrow_recovery_response = PASSCROW_PROTO_VERSION
 
@@ -302,9 +272,9 @@ class DeletionRequest(_json_object):
     _KEYS = {
         "passcrow-deletion-request": str,
         "escrow-data-id": str}
-
-    passcrow_deletion_request = property(*_json_object_prop('passcrow-deletion-request'))
-    escrow_data_id = property(*_json_object_prop('escrow-data-id'))
+    _LIMITS = {
+        "passcrow-deletion-request": 16,
+        "escrow-data-id": 128}
 
     def _set_defaults(self):
         self.passcrow_deletion_request = PASSCROW_PROTO_VERSION
@@ -322,10 +292,6 @@ class DeletionResponse(_json_object):
         "escrow-data-id": str,
         "error": str}
 
-    passcrow_deletion_response = property(*_json_object_prop('passcrow-deletion-response'))
-    escrow_data_id = property(*_json_object_prop('escrow-data-id'))
-    error = property(*_json_object_prop('error'))
-
     def _set_defaults(self):
         self.passcrow_deletion_response = PASSCROW_PROTO_VERSION
 
@@ -346,13 +312,6 @@ class PaymentScheme(_json_object):
         "hashcash-bits": int,
         "tokens": _json_list(str)}
 
-    scheme = property(*_json_object_prop('scheme'))
-    scheme_id = property(*_json_object_prop('scheme-id'))
-    description = property(*_json_object_prop('description'))
-    expiration_seconds = property(*_json_object_prop('expiration-seconds'))
-    hashcash_bits = property(*_json_object_prop('hashcash-bits'))
-    tokens = property(*_json_object_prop('tokens'))
-
 
 class PolicyObject(_json_object):
     """
@@ -371,14 +330,6 @@ class PolicyObject(_json_object):
     def _set_defaults(self):
         self.passcrow_versions = PASSCROW_SUPPORTED_VERS
 
-    passcrow_versions = property(*_json_object_prop('passcrow-versions'))
-    country_code = property(*_json_object_prop('country-code'))
-    about_url = property(*_json_object_prop('about-url'))
-    kinds = property(*_json_object_prop('kinds'))
-    max_request_bytes = property(*_json_object_prop('max-request-bytes'))
-    max_expiration_seconds = property(*_json_object_prop('max-expiration-seconds'))
-    max_timeout_seconds = property(*_json_object_prop('max-timeout-seconds'))
-    payment_schemes = property(*_json_object_prop('payment-schemes'))
 
 
 if __name__ == "__main__":
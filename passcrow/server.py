@@ -1,6 +1,8 @@
 import hashlib
+import math
 import os
 import sys
+import threading
 import time
 import traceback
 
@@ -9,11 +11,13 @@ import appdirs
 from .proto import *
 
 from . import VERSION
+from . import cbor
 from .handlers.email import EmailHandler
-from .payments import PaymentFree, PaymentHashcash
+from .payments import PaymentFree, PaymentHashcash, PaymentVoucher
+from .payments import PaymentLoad
 from .secret_share import random_int
 from .storage import FileSystemStorage
-from .util import cute_str, _json_object, _json_object_prop
+from .util import cute_str, _json_object, _json_validator
 
 
 if os.getuid() == 0 and sys.platform != 'win32':
@@ -29,6 +33,7 @@ DEFAULT_VRFY_TIMEOUT = 1800
 DEFAULT_MAX_REQ_BYTES = 4096  # One HDD block, enough for ephemeral recovery
 
 DEFAULT_FREE_TIME = 25 * 3600
+DEFAULT_POLICY_MAX_AGE = 24 * 3600  # How long clients may cache our policy
 DEFAULT_HASHCASH_PARAMS = [
     (11,    183*24*3600),    # Etd time: 1s  (on my Intel Core i5-1035G1)
     (12,    366*24*3600),    #           2s
@@ -36,10 +41,102 @@ DEFAULT_HASHCASH_PARAMS = [
     (14,  5*366*24*3600),    #           8s
     (15, 10*366*24*3600)]    #          16s
 
+DEFAULT_CHEAP_ENDPOINTS = ('policy', 'stats')
+DEFAULT_ENDPOINT_LIMITS = {
+    'escrowrequest': 4,
+    'deletionrequest': 4,
+    'recoveryrequest': 4,
+    'verificationrequest': 4}
+
 
 class JsonError(_json_object):
-    _KEYS = {'error': str}
-    error = property(*_json_object_prop('error'))
+    _KEYS = {'error': str, 'retry-after': int}
+
+
+class ServerBusy(Exception):
+    def __init__(self, retry_after):
+        super().__init__('Busy, retry after %d seconds' % retry_after)
+        self.retry_after = retry_after
+
+
+class AdmissionControl:
+    """
+    Per-endpoint concurrency limits with a bounded wait queue.
+
+    At most `max_concurrency` requests are processed at once, but only
+    the cheap endpoints (policy, stats) may use the last `reserved`
+    slots. Expensive endpoints are further limited by `limits`. When an
+    endpoint is saturated, up to `max_waiting` requests will wait at most
+    `max_wait` seconds for a slot; beyond that, requests are refused
+    immediately with ServerBusy.
+    """
+    def __init__(self,
+            max_concurrency=16,
+            reserved=2,
+            limits=None,
+            cheap=DEFAULT_CHEAP_ENDPOINTS,
+            max_waiting=8,
+            max_wait=5):
+        self.max_concurrency = max_concurrency
+        self.reserved = reserved
+        self.limits = limits if (limits is not None) else DEFAULT_ENDPOINT_LIMITS
+        self.cheap = cheap
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.total = 0
+        self.active = {}
+        self.waiting = {}
+        self._cond = threading.Condition()
+
+    def _can_run(self, endpoint):
+        total_max = self.max_concurrency
+        if endpoint not in self.cheap:
+            total_max -= self.reserved
+        return ((self.total < total_max) and
+            (self.active.get(endpoint, 0) < self.limits.get(endpoint, total_max)))
+
+    def _retry_after(self, endpoint, est_seconds):
+        slots = self.limits.get(endpoint, self.max_concurrency)
+        queued = self.waiting.get(endpoint, 0) + 1
+        return max(1, int(math.ceil(est_seconds * queued / max(1, slots))))
+
+    def acquire(self, endpoint, est_seconds=1):
+        with self._cond:
+            if self._can_run(endpoint):
+                self.total += 1
+                self.active[endpoint] = self.active.get(endpoint, 0) + 1
+                return
+
+            if self.waiting.get(endpoint, 0) >= self.max_waiting:
+                raise ServerBusy(self._retry_after(endpoint, est_seconds))
+
+            deadline = time.time() + self.max_wait
+            self.waiting[endpoint] = self.waiting.get(endpoint, 0) + 1
+            try:
+                while not self._can_run(endpoint):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise ServerBusy(
+                            self._retry_after(endpoint, est_seconds))
+                    self._cond.wait(remaining)
+                self.total += 1
+                self.active[endpoint] = self.active.get(endpoint, 0) + 1
+            finally:
+                self.waiting[endpoint] -= 1
+
+    def release(self, endpoint):
+        with self._cond:
+            self.total -= 1
+            self.active[endpoint] -= 1
+            self._cond.notify_all()
+
+    def get_stats(self):
+        with self._cond:
+            stats = {'total_active': self.total}
+            for ep in set(self.active) | set(self.waiting):
+                stats[ep + '_active'] = self.active.get(ep, 0)
+                stats[ep + '_waiting'] = self.waiting.get(ep, 0)
+            return stats
 
 
 class ServerStats(_json_object):
@@ -48,30 +145,45 @@ class ServerStats(_json_object):
         'start-ts': int,
         'requests': dict,
         'storage': dict,
+        'logging': dict,
+        'queues': dict,
         'handlers': list}
-    version = property(*_json_object_prop('version'))
-    start_ts = property(*_json_object_prop('start-ts'))
-    requests = property(*_json_object_prop('requests'))
-    storage = property(*_json_object_prop('storage'))
-    handlers = property(*_json_object_prop('handlers'))
 
 
 class PasscrowServer:
     STORAGE_TABLES = {
         'escrow': ['data'],
         'vcodes': ['data'],
-        'rlimit': ['data']}
+        'rlimit': ['data'],
+        'spent': ['data'],
+        'vouchers': ['data']}
 
     def __init__(self, storage,
             log=None,
+            request_log=None,
+            admission=None,
             handlers=None,
             payments=None,
             country_code=None,
             about_url=None,
             expiration=None,
             max_request_bytes=None,
-            vrfy_timeout=None):
+            vrfy_timeout=None,
+            shared_spent=None,
+            payment_load=None,
+            hashcash_params=None,
+            extra_payments=None,
+            policy_max_age=None):
         self.log = log or print
+        self.request_log = request_log
+        self.admission = admission
+        self.payment_load = payment_load
+        self.policy_max_age = policy_max_age or DEFAULT_POLICY_MAX_AGE
+        if payment_load is not None:
+            # Clients caching a policy longer than this would offer stale
+            # (too cheap) hashcash, which we no longer accept.
+            self.policy_max_age = min(self.policy_max_age, payment_load.grace)
+        self._policy_cache = None
         self.storage = storage
 
         self.country_code = country_code or '??'
@@ -86,14 +198,22 @@ class PasscrowServer:
             storage={})
 
         if not payments:
+            spent = PaymentHashcash.MakeSpentTokens(
+                storage=(self.storage if shared_spent else None))
             payments = [PaymentFree(min(self.expiration, DEFAULT_FREE_TIME))]
-            for bits, exp in DEFAULT_HASHCASH_PARAMS:
+            for bits, exp in (hashcash_params or DEFAULT_HASHCASH_PARAMS):
                 if exp < self.expiration:
-                    payments.append(PaymentHashcash(self.storage, bits, exp))
+                    payments.append(PaymentHashcash(
+                        self.storage, bits, exp, spent, payment_load))
                 else:
-                    payments.append(
-                        PaymentHashcash(self.storage, bits, self.expiration))
+                    payments.append(PaymentHashcash(
+                        self.storage, bits, self.expiration, spent,
+                        payment_load))
                     break
+        payments = list(payments) + list(extra_payments or [])
+        for p in payments:
+            if getattr(p, 'storage', False) is None:
+                p.storage = self.storage
         self.payments = dict((p.scheme_id, p) for p in payments)
         self.handlers = handlers or {
             'mailto': EmailHandler(),
@@ -105,6 +225,15 @@ class PasscrowServer:
             'deletionrequest': self.process_DeletionRequest,
             'recoveryrequest': self.process_RecoveryRequest,
             'verificationrequest': self.process_VerificationRequest}
+        # Cheap checks, compiled from the protocol schemas, which let us
+        # reject malformed requests before doing any real work.
+        self.validators = dict(
+            (ep, _json_validator(cls, max_str=self.max_request_bytes))
+            for ep, cls in (
+                ('escrowrequest', EscrowRequest),
+                ('deletionrequest', DeletionRequest),
+                ('recoveryrequest', RecoveryRequest),
+                ('verificationrequest', VerificationRequest)))
         for ep in self.endpoints:
             self.server_stats.requests[ep+'_ok'] = 0
             self.server_stats.requests[ep+'_ok_usec'] = 0
@@ -113,20 +242,67 @@ class PasscrowServer:
         for table, columns in self.STORAGE_TABLES.items():
             self.storage.prepare_table(table, columns)
 
-    def handle(self, user_info, rpc_method, rdata):
+    def _log_request(self, rpc_method, rl_id, t0, outcome):
+        self.request_log.record(
+            method=rpc_method,
+            latency_us=int(1000000 * (time.time() - t0)),
+            outcome=outcome,
+            rl_id=rl_id)
+
+    def handle_encoded(self, user_info, rpc_method, rdata, content_type=None):
+        """
+        Handle a request, returning a (content_type, bytes) tuple with the
+        response encoded in the same wire format as the request.
+        """
+        ctype = (content_type or '').split(';')[0].strip().lower()
+        resp = self.handle(user_info, rpc_method, rdata, content_type=ctype)
+        if ctype == cbor.CONTENT_TYPE:
+            return cbor.CONTENT_TYPE, cbor.dumps(resp)
+        return 'application/json', bytes(resp)
+
+    def cache_headers(self, rpc_method, body, if_none_match=None):
+        """
+        Generate HTTP caching headers for a response, returning a (status,
+        headers) tuple. Policies get an ETag and a max-age, and if the
+        client already has the current policy the status is 304 (Not
+        Modified) and the body should be omitted.
+        """
+        if rpc_method != 'policy':
+            return 200, {}
+        etag = '"%s"' % hashlib.sha256(body).hexdigest()[:32]
+        headers = {
+            'ETag': etag,
+            'Cache-Control': 'max-age=%d' % self.policy_max_age}
+        if if_none_match and etag in if_none_match:
+            return 304, headers
+        return 200, headers
+
+    def handle(self, user_info, rpc_method, rdata, content_type=None):
+        t0 = time.time()
+        rl_id = None
         try:
-            t0 = time.time()
             try:
                 if isinstance(rdata, dict):
                     json_data = rdata
                 else:
                     if len(rdata) > self.max_request_bytes:
                         return JsonError(error='Request too large')
-                    json_data = json.loads(rdata or '{}')
+                    if content_type == cbor.CONTENT_TYPE:
+                        json_data = cbor.loads(rdata) if rdata else {}
+                    else:
+                        json_data = json.loads(rdata or '{}')
             except:
                 raise Exception('Bad request')
 
             rl_id = hashlib.md5(bytes(str(user_info), 'utf-8')).hexdigest()
+            try:
+                endpoint = self.endpoints[rpc_method]
+            except KeyError:
+                raise Exception(('Unsupported: %s' % rpc_method))
+            validator = self.validators.get(rpc_method)
+            if validator is not None:
+                validator(json_data)
+
             try:
                 self.storage.fetch('rlimit', '0-%s' % rl_id)
                 raise Exception('Sorry, rate limited.')
@@ -135,9 +311,13 @@ class PasscrowServer:
                     row_id=rl_id,
                     expiration=int(time.time() + 1))
 
-            try:
+            if self.request_log is None:
                 self.log('%s method=%s' % (user_info, rpc_method))
-                rv = self.endpoints[rpc_method](json_data)
+            if self.admission is not None:
+                est_usec = self.server_stats.requests[rpc_method+'_ok_usec']
+                self.admission.acquire(rpc_method, est_usec / 1000000.0)
+            try:
+                rv = endpoint(json_data)
 
                 # Calculate and update performance stats
                 self.server_stats.requests[rpc_method+'_ok'] += 1
@@ -146,33 +326,58 @@ class PasscrowServer:
                 wus = int((0.1 * rus) + (0.9 * wus)) if wus else rus
                 self.server_stats.requests[rpc_method+'_ok_usec'] = wus
 
+                if self.request_log is not None:
+                    self._log_request(rpc_method, rl_id, t0,
+                        'failed' if ('error' in rv) else 'ok')
                 return rv
-            except KeyError:
-                raise Exception(('Unsupported: %s' % rpc_method))
+            finally:
+                if self.admission is not None:
+                    self.admission.release(rpc_method)
+        except ServerBusy as e:
+            self.server_stats.requests[rpc_method + '_err'] += 1
+            if self.request_log is not None:
+                self._log_request(rpc_method, rl_id, t0, 'busy')
+            return JsonError(error=str(e), retry_after=e.retry_after)
         except Exception as e:
             if rpc_method in self.endpoints:
-                ekey += rpc_method + '_err'
-                self.server_stats.requests[rpc_method] += 1
+                self.server_stats.requests[rpc_method + '_err'] += 1
+            if self.request_log is not None:
+                self._log_request(rpc_method, rl_id, t0, 'rejected')
             return JsonError(error=str(e))
 
     def generate_Stats(self, request_dict):
         self.server_stats.storage = self.storage.get_stats()
         self.server_stats.handlers = list(self.handlers.keys())
+        if self.request_log is not None:
+            self.server_stats.logging = self.request_log.get_stats()
+        if self.admission is not None:
+            self.server_stats.queues = self.admission.get_stats()
         return self.server_stats
 
     def generate_Policy(self, request_dict):
+        # The policy rarely changes, so we reuse a pre-encoded response
+        # until one of the payment schemes changes.
+        payment_schemes = [
+            p.get_policy(request_dict) for p in self.payments.values()]
+        cache_key = [id(ps) for ps in payment_schemes]
+        if self._policy_cache and self._policy_cache[0] == cache_key:
+            return self._policy_cache[1]
+
         po = PolicyObject()
+        po.passcrow_versions = PASSCROW_SUPPORTED_VERS + (PASSCROW_CBOR_VERSION,)
         po.country_code = self.country_code
         po.about_url = self.about_url
         po.kinds = sorted(self.handlers.keys())
         po.max_request_bytes = self.max_request_bytes
         po.max_expiration_seconds = self.expiration
         po.max_timeout_seconds = self.vrfy_timeout
-        po.payment_schemes = [
-            p.get_policy(request_dict) for p in self.payments.values()]
+        po.payment_schemes = payment_schemes
+        self._policy_cache = (cache_key, po.freeze())
         return po
 
     def _take_payment(self, token, data):
+        if self.payment_load is not None:
+            self.payment_load.tick()
         try:
             scheme, cash = token.split(':', 1)
             return self.payments[scheme].process(cash, data)
@@ -182,7 +387,7 @@ class PasscrowServer:
     def process_EscrowRequest(self, request_dict):
         resp = EscrowResponse()
         try:
-            req = EscrowRequest(request_dict)
+            req = EscrowRequest.from_json(request_dict)
             escrow_data = ''.join(req.escrow_data)
 
             # Note: as a side-effect, this verifies that we can actually
@@ -229,7 +434,7 @@ class PasscrowServer:
     def process_DeletionRequest(self, request_dict):
         resp = DeletionResponse()
         try:
-            req = DeletionRequest(request_dict)
+            req = DeletionRequest.from_json(request_dict)
             self.storage.delete('escrow', req.escrow_data_id)
             self.storage.delete('vcodes', req.escrow_data_id)
             return resp
@@ -243,7 +448,7 @@ class PasscrowServer:
     def process_VerificationRequest(self, request_dict):
         resp = VerificationResponse()
         try:
-            req = VerificationRequest(request_dict)
+            req = VerificationRequest.from_json(request_dict)
             resp.escrow_data_id = _id = req.escrow_data_id
             if len(req.prefix) > 1:
                 raise ValueError('Bad prefix: %s' % req.prefix)
@@ -279,8 +484,8 @@ class PasscrowServer:
     def process_RecoveryRequest(self, request_dict):
         resp = RecoveryResponse()
         try:
-            req = RecoveryRequest(request_dict)
-            resp.escrow_data_id = _id = req.escrow_data_id
+            req = RecoveryRequest.from_json(request_dict)
+            _id = req.escrow_data_id
 
             vcode = str(self.storage.fetch('vcodes', _id)[0].strip(), 'utf-8')
             if req.verification.strip().upper() != vcode.upper():
@@ -366,6 +571,54 @@ max_request_bytes = 4096             # Plenty for Ephemeral recovery
 expiration        = 366 * 24 * 3600  # Max time-to-live for escrowed data
 vrfy_timeout      = 24 * 3600        # Max time-to-live for verification codes
 
+# How long clients may cache our policy. If payment_load (below) is enabled,
+# this is capped at its grace period.
+#
+#policy_max_age    = 24 * 3600
+
+# Spent hashcash tokens are tracked in RAM to prevent replays. If you run
+# multiple server processes, they must share this record via storage:
+#
+#shared_spent      = True
+
+# Hashcash tiers, as (bits, expiration seconds) pairs. The defaults were
+# tuned by hand; to generate tiers suited to this machine, run:
+#
+#   python3 -m passcrow.payments calibrate
+#
+#hashcash_params = [
+#    (11,    183*24*3600),
+#    (12,    366*24*3600),
+#    (13,  2*366*24*3600),
+#    (14,  5*366*24*3600),
+#    (15, 10*366*24*3600)]
+
+# Prepaid vouchers, which clients can use instead of hashcash. Vouchers are
+# cheap for the server to verify, which makes sense for high-volume users.
+# Issue them with `python3 -m passcrow.server vouchers=N /path/to/config`.
+# Keep the secret secret!
+#
+#extra_payments = [
+#    PaymentVoucher(secret='%s', value=expiration)]
+
+# Load-adaptive hashcash; demand one extra bit of work for every doubling of
+# the escrow request rate above the baseline (requests/second). Uncomment
+# to enable:
+#
+#payment_load = PaymentLoad(baseline=0.2, max_extra_bits=6)
+
+
+# Load shedding; limit how many requests are processed at once, so a burst
+# of expensive escrow requests cannot starve the cheap policy and stats
+# endpoints. Saturated endpoints answer "busy, retry after N seconds".
+# Uncomment to enable:
+#
+#admission = AdmissionControl(
+#    max_concurrency = 16,   # Total requests processed at once
+#    reserved        = 2,    # Slots reserved for policy and stats requests
+#    max_waiting     = 8,    # Requests allowed to queue, per endpoint
+#    max_wait        = 5)    # Seconds to wait in queue before giving up
+
 
 # Verification handlers
 #
@@ -399,6 +652,15 @@ email_handler = EmailHandler(
 #    api_token    = '12341241234')
 
 
+# Structured request logging; JSON-lines records are written by a background
+# thread, so slow disks never delay requests. Uncomment to enable:
+#
+#from passcrow.server_log import AsyncJsonLog
+#request_log = AsyncJsonLog('/var/log/passcrow/requests.jsonl',
+#    max_bytes = 16 * 1024 * 1024,   # Rotate logs at this size ...
+#    backups   = 5)                  # ... keeping this many old logs.
+
+
 handlers = {
 #   'sms': sms_handler,        # Uncomment to enable sms: verification
 #   'tel': sms_handler,        # Uncomment to enable tel: verfication
@@ -407,7 +669,8 @@ handlers = {
 #EOF#
 """ % (
                 cute_str(data_dir, quotes="'"),
-                os.getenv('LANG', '??').split('.')[0].split('_')[-1]))
+                os.getenv('LANG', '??').split('.')[0].split('_')[-1],
+                os.urandom(16).hex()))
 
         return config_file
 
@@ -416,13 +679,20 @@ handlers = {
     def FromConfig(cls, args):
         SERVER_SETTINGS = {
             'log': ValueError,
+            'request_log': ValueError,
+            'admission': ValueError,
             'handlers': ValueError,
             'payments': ValueError,
             'country_code': str,
             'about_url': str,
             'expiration': int,
             'max_request_bytes': int,
-            'vrfy_timeout': int}
+            'vrfy_timeout': int,
+            'shared_spent': int,
+            'payment_load': ValueError,
+            'hashcash_params': ValueError,
+            'extra_payments': ValueError,
+            'policy_max_age': int}
 
         data_dir = DEFAULT_DATA_DIR
         config_file = os.path.join(DEFAULT_CONFIG_DIR, 'server_config.py')
@@ -474,10 +744,21 @@ handlers = {
         print(json.dumps(stats, indent=2))
         return True
 
+    def cli_vouchers(self, count=10):
+        vouchers = [p for p in self.payments.values()
+            if isinstance(p, PaymentVoucher)]
+        if not vouchers:
+            sys.stderr.write('No voucher payment schemes are configured.\n')
+            return False
+        for p in vouchers:
+            for voucher in p.issue(int(count)):
+                print('%s %s' % (p.scheme_id, voucher))
+        return True
+
 
 if __name__ == '__main__':
     try:
-        command = sys.argv[1]
+        command, _, arg = sys.argv[1].partition('=')
         server = PasscrowServer.FromConfig(sys.argv[2:])
         if not hasattr(server, 'cli_' + command):
             raise ValueError('Invalid command')
@@ -488,7 +769,8 @@ Usage: python3 -m passcrow.server CMD /path/to/config.py [<SERVER-OPTS>]
 Where CMD is one of:
 
     cleanup      Perform regular maintenance (expire old data, etc.)
+    vouchers=N   Issue N prepaid vouchers for each voucher payment scheme
 
 """)
         sys.exit(1)
-    sys.exit(0 if getattr(server, 'cli_' + command)() else 1)
+    sys.exit(0 if getattr(server, 'cli_' + command)(*([arg] if arg else [])) else 1)
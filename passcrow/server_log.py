@@ -0,0 +1,176 @@
+"""Passcrow server request logging
+
+This is a structured (JSON-lines) log which keeps disk I/O off the request
+path: records are placed on a bounded in-memory queue and written out by a
+background thread. If the writer cannot keep up, records are dropped and
+counted, so logging can never stall the server.
+
+Example server_config.py snippet:
+
+    from passcrow.server_log import AsyncJsonLog
+    request_log = AsyncJsonLog('/var/log/passcrow/requests.jsonl')
+
+An AsyncJsonLog instance is also callable, so it can be used as the
+server's `log` function for free-form messages.
+"""
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+
+DEFAULT_MAX_QUEUE = 10000
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_BACKUPS = 5
+DEFAULT_BATCH = 250
+
+
+class AsyncJsonLog:
+    def __init__(self, path=None,
+            fd=None,
+            max_queue=DEFAULT_MAX_QUEUE,
+            max_bytes=DEFAULT_MAX_BYTES,
+            backups=DEFAULT_BACKUPS):
+        if path and fd:
+            raise ValueError('Please provide a path or a file, not both')
+        self.path = path
+        self.fd = fd if (fd or path) else sys.stderr
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self._reported_drops = 0
+        self._size = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def get_stats(self):
+        return {
+            'pending': self._queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped}
+
+    def __call__(self, message):
+        return self.record(msg=str(message))
+
+    def record(self, **fields):
+        """Queue a record for writing; never blocks. Returns False if the
+        record was dropped because the queue is full."""
+        if self._thread is None:
+            self._start()
+        fields['ts'] = round(time.time(), 3)
+        try:
+            self._queue.put_nowait(fields)
+            self.queued += 1
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def close(self, timeout=5):
+        if self._thread is not None:
+            try:
+                self._queue.put(None, timeout=timeout)
+                self._thread.join(timeout)
+            except queue.Full:
+                pass
+            self._thread = None
+        if self.path and self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._writer, name='passcrow-log', daemon=True)
+                self._thread.start()
+
+    def _open(self):
+        if self.path and self.fd is None:
+            self.fd = open(self.path, 'a')
+            self._size = self.fd.tell()
+
+    def _rotate(self):
+        self.fd.close()
+        self.fd = None
+        for i in reversed(range(1, self.backups)):
+            src = '%s.%d' % (self.path, i)
+            if os.path.exists(src):
+                os.replace(src, '%s.%d' % (self.path, i + 1))
+        if self.backups > 0:
+            os.replace(self.path, '%s.1' % self.path)
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def _encode(self, record):
+        return json.dumps(record, separators=(',', ':'), default=str) + '\n'
+
+    def _writer(self):
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            while len(batch) < DEFAULT_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = [r for r in batch if r is not None]
+
+            dropped = self.dropped
+            if dropped != self._reported_drops:
+                batch.append({
+                    'ts': round(time.time(), 3),
+                    'event': 'dropped',
+                    'count': dropped - self._reported_drops})
+                self._reported_drops = dropped
+
+            try:
+                self._open()
+                data = ''.join(self._encode(r) for r in batch)
+                self.fd.write(data)
+                self.fd.flush()
+                self.written += len(batch)
+                if self.path:
+                    self._size += len(data)
+                    if self.max_bytes and self._size >= self.max_bytes:
+                        self._rotate()
+            except (OSError, IOError, ValueError):
+                self.dropped += len(batch)
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    tmp = tempfile.mkdtemp(suffix='.pclog')
+    log = AsyncJsonLog(os.path.join(tmp, 'test.jsonl'),
+        max_queue=100, max_bytes=4096, backups=2)
+    for i in range(0, 1000):
+        log.record(method='policy', latency_us=i, outcome='ok', rl_id='x')
+        if i % 50 == 0:
+            time.sleep(0.01)
+    log('Hello world')
+    log.close()
+
+    lines = 0
+    for fn in os.listdir(tmp):
+        with open(os.path.join(tmp, fn), 'r') as fd:
+            for line in fd:
+                json.loads(line)
+                lines += 1
+    assert(log.written + log.dropped >= 1001)
+    assert(len(os.listdir(tmp)) <= 3)
+    print('%d written, %d dropped, %d lines kept in %s'
+        % (log.written, log.dropped, lines, sorted(os.listdir(tmp))))
+    os.system('rm -rf %s' % tmp)
+    print('ok')
@@ -87,7 +87,13 @@ class FileSystemStorage:
                     unexpired += 1
         return expired, unexpired
 
-    def insert(self, table, *data, rand_max=None, row_id=None, expiration=0):
+    def insert(self, table, *data,
+            rand_max=None, row_id=None, expiration=0, exclusive=False):
+        """
+        Insert a row, returning its ID. If `exclusive` is set, the row is
+        created atomically and a FileExistsError is raised if it already
+        exists, which makes it usable as a marker shared between processes.
+        """
         table = _bytes(table, 'latin-1')
         if not os.path.exists(os.path.join(self.workdir, table)):
             raise KeyError('No such table: %s' % table)
@@ -97,7 +103,8 @@ class FileSystemStorage:
         row_id = b'%x-%s' % (int(expiration), row_id.split(b'-')[-1])
         for col, cdata in enumerate(data):
             cpath = self._row_path(table, row_id, col)
-            with open(cpath, 'wb') as fd:
+            mode = 'xb' if (exclusive and col == 0) else 'wb'
+            with open(cpath, mode) as fd:
                 cdata = _bytes(cdata, 'latin-1')
                 fd.write(cdata)
         return str(row_id, 'latin-1')
@@ -164,6 +171,14 @@ if __name__ == '__main__':
     except KeyError:
         pass
 
+    fss.insert('testing', 'once', row_id='abc', exclusive=True)
+    try:
+        fss.insert('testing', 'twice', row_id='abc', exclusive=True)
+        assert(not 'reached')
+    except FileExistsError:
+        pass
+    assert([b'once'] == fss.fetch('testing', 'abc'))
+
     id3 = fss.insert('testing', 'stuff', rand_max=1000000)
     print('%s' % id3)
     assert([b'stuff'] == fss.fetch('testing', id3.split('-')[-1]))
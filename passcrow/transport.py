@@ -0,0 +1,365 @@
+"""Passcrow client HTTPS transport
+
+A small keep-alive connection pool built on http.client, so a series of
+requests to the same Passcrow server (policy, escrow, verification, ...)
+reuses one TLS session instead of reconnecting each time.
+
+An HTTPSPool instance is a drop-in replacement for the client's
+`urlopen_func`:
+
+    pool = HTTPSPool()
+    client = PasscrowClient(urlopen_func=pool)
+
+Responses are read in full (up to a size limit) and returned as file-like
+objects, which also carry the HTTP `status` and `headers`.
+
+AsyncHTTPSPool does the same using asyncio streams, for use with
+AsyncPasscrowClient.
+"""
+import asyncio
+import email.parser
+import http.client
+import io
+import ssl
+import threading
+import time
+import urllib.parse
+
+
+DEFAULT_IDLE_TIMEOUT = 60
+DEFAULT_TIMEOUT = 30
+DEFAULT_MAX_RESPONSE_BYTES = 1024 * 1024
+
+# Errors which mean a kept-alive connection was closed by the server
+# while idle; the request was not processed and can safely be retried.
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    BrokenPipeError,
+    ConnectionResetError)
+
+
+class HTTPResponse(io.BytesIO):
+    def __init__(self, status, reason, headers, body):
+        super().__init__(body)
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+    def getcode(self):
+        return self.status
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+
+class HTTPSPool:
+    def __init__(self,
+            idle_timeout=DEFAULT_IDLE_TIMEOUT,
+            timeout=DEFAULT_TIMEOUT,
+            max_response_bytes=DEFAULT_MAX_RESPONSE_BYTES,
+            ssl_context=None):
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.max_response_bytes = max_response_bytes
+        self.ssl_context = ssl_context or ssl.create_default_context()
+        self.idle = {}  # (scheme, netloc) -> (connection, last used)
+        self.lock = threading.Lock()
+        self.connects = 0
+        self.requests = 0
+
+    def _connect(self, scheme, netloc):
+        self.connects += 1
+        if scheme == 'http':
+            return http.client.HTTPConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPSConnection(
+            netloc, timeout=self.timeout, context=self.ssl_context)
+
+    def _take(self, key):
+        now = time.time()
+        with self.lock:
+            for k, (conn, last_used) in list(self.idle.items()):
+                if now - last_used > self.idle_timeout:
+                    del self.idle[k]
+                    conn.close()
+            conn, last_used = self.idle.pop(key, (None, None))
+        return conn
+
+    def _give_back(self, key, conn):
+        with self.lock:
+            old = self.idle.get(key)
+            self.idle[key] = (conn, time.time())
+        if old is not None:
+            old[0].close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conn, last_used in idle.values():
+            conn.close()
+
+    def _request(self, conn, method, path, data, headers):
+        conn.request(method, path, body=data, headers=headers)
+        resp = conn.getresponse()
+        body = resp.read(self.max_response_bytes + 1)
+        if len(body) > self.max_response_bytes:
+            conn.close()
+            raise IOError('Response too large')
+        return resp, body
+
+    def __call__(self, url, data=None, headers={}):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError('Unsupported URL: %s' % url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        method = 'GET' if (data is None) else 'POST'
+
+        self.requests += 1
+        conn = self._take(key)
+        try:
+            if conn is not None:
+                try:
+                    resp, body = self._request(conn, method, path, data, headers)
+                except STALE_CONNECTION_ERRORS:
+                    conn.close()
+                    conn = None
+            if conn is None:
+                conn = self._connect(*key)
+                resp, body = self._request(conn, method, path, data, headers)
+        except:
+            if conn is not None:
+                conn.close()
+            raise
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self._give_back(key, conn)
+
+        if not (200 <= resp.status < 300 or resp.status == 304):
+            raise IOError('HTTP %d %s' % (resp.status, resp.reason))
+        return HTTPResponse(resp.status, resp.reason, resp.headers, body)
+
+
+class AsyncHTTPSPool:
+    """
+    The asyncio equivalent of HTTPSPool, built on asyncio streams; an
+    instance is an awaitable `urlopen_func` for AsyncPasscrowClient.
+    """
+    def __init__(self,
+            idle_timeout=DEFAULT_IDLE_TIMEOUT,
+            timeout=DEFAULT_TIMEOUT,
+            max_response_bytes=DEFAULT_MAX_RESPONSE_BYTES,
+            ssl_context=None):
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.max_response_bytes = max_response_bytes
+        self.ssl_context = ssl_context or ssl.create_default_context()
+        self.idle = {}  # (scheme, netloc) -> [(reader, writer, last used)]
+        self.connects = 0
+        self.requests = 0
+
+    async def _connect(self, scheme, netloc):
+        self.connects += 1
+        parts = urllib.parse.urlsplit('//' + netloc)
+        port = parts.port or (80 if (scheme == 'http') else 443)
+        return await asyncio.wait_for(
+            asyncio.open_connection(parts.hostname, port,
+                ssl=(None if (scheme == 'http') else self.ssl_context)),
+            self.timeout)
+
+    def _take(self, key):
+        now = time.time()
+        for k, conns in list(self.idle.items()):
+            for conn in [c for c in conns if now - c[2] > self.idle_timeout]:
+                conns.remove(conn)
+                conn[1].close()
+        conns = self.idle.get(key)
+        if conns:
+            reader, writer, last_used = conns.pop()
+            return reader, writer
+        return None
+
+    def _give_back(self, key, conn):
+        self.idle.setdefault(key, []).append(conn + (time.time(),))
+
+    def close(self):
+        idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for reader, writer, last_used in conns:
+                writer.close()
+
+    async def _read_body(self, reader, hdrs):
+        if 'chunked' in hdrs.get('Transfer-Encoding', '').lower():
+            body = b''
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if len(body) + size > self.max_response_bytes:
+                    raise IOError('Response too large')
+                if size:
+                    body += await reader.readexactly(size)
+                await reader.readline()
+                if not size:
+                    break
+            return body, True
+        if 'Content-Length' in hdrs:
+            length = int(hdrs['Content-Length'])
+            if length > self.max_response_bytes:
+                raise IOError('Response too large')
+            return await reader.readexactly(length), True
+        body = await reader.read(self.max_response_bytes + 1)
+        if len(body) > self.max_response_bytes:
+            raise IOError('Response too large')
+        return body, False
+
+    async def _request(self, conn, method, parts, data, headers):
+        reader, writer = conn
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % parts.netloc]
+        for k, v in headers.items():
+            lines.append('%s: %s' % (k, v))
+        if data is not None:
+            lines.append('Content-Length: %d' % len(data))
+        writer.write(bytes('\r\n'.join(lines) + '\r\n\r\n', 'latin-1'))
+        if data is not None:
+            writer.write(data)
+        await writer.drain()
+
+        async def _read_response():
+            status_line = await reader.readline()
+            if not status_line:
+                raise http.client.RemoteDisconnected('Connection closed')
+            try:
+                version, status, reason = (
+                    str(status_line, 'latin-1').rstrip() + ' ').split(' ', 2)
+                status = int(status)
+            except ValueError:
+                raise http.client.BadStatusLine(status_line)
+            hlines = []
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                hlines.append(str(line, 'latin-1'))
+            hdrs = email.parser.Parser().parsestr(''.join(hlines))
+            if status in (204, 304) or method == 'HEAD':
+                body, reusable = b'', True
+            else:
+                body, reusable = await self._read_body(reader, hdrs)
+            if (hdrs.get('Connection', '').lower() == 'close'
+                    or version == 'HTTP/1.0'):
+                reusable = False
+            return status, reason.strip(), hdrs, body, reusable
+
+        return await asyncio.wait_for(_read_response(), self.timeout)
+
+    async def __call__(self, url, data=None, headers={}):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError('Unsupported URL: %s' % url)
+        key = (parts.scheme, parts.netloc)
+        method = 'GET' if (data is None) else 'POST'
+
+        self.requests += 1
+        conn = self._take(key)
+        try:
+            if conn is not None:
+                try:
+                    result = await self._request(
+                        conn, method, parts, data, headers)
+                except STALE_CONNECTION_ERRORS + (
+                        asyncio.IncompleteReadError,):
+                    conn[1].close()
+                    conn = None
+            if conn is None:
+                conn = await self._connect(*key)
+                result = await self._request(
+                    conn, method, parts, data, headers)
+        except BaseException:
+            # Includes cancellation: the connection state is unknown
+            if conn is not None:
+                conn[1].close()
+            raise
+
+        status, reason, hdrs, body, reusable = result
+        if reusable:
+            self._give_back(key, conn)
+        else:
+            conn[1].close()
+
+        if not (200 <= status < 300 or status == 304):
+            raise IOError('HTTP %d %s' % (status, reason))
+        return HTTPResponse(status, reason, hdrs, body)
+
+
+if __name__ == '__main__':
+    import http.server
+    import json
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def do_POST(self):
+            data = self.rfile.read(int(self.headers['Content-Length']))
+            body = json.dumps({'echo': str(data, 'utf-8')}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            if data == b'bye':
+                self.close_connection = True  # ...without telling client
+        def log_message(self, *args):
+            pass
+
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%d/passcrow/policy' % httpd.server_address[1]
+
+    pool = HTTPSPool(max_response_bytes=64)
+    for i in range(0, 5):
+        resp = pool(url, data=b'hello %d' % i)
+        assert(json.load(resp) == {'echo': 'hello %d' % i})
+    assert(pool.connects == 1)
+
+    # The server silently drops our idle connection, we should reconnect
+    pool(url, data=b'bye')
+    time.sleep(0.1)
+    assert(json.load(pool(url, data=b'again')) == {'echo': 'again'})
+    assert(pool.connects == 2)
+
+    try:
+        pool(url, data=b'x' * 100)
+        assert(not 'reached')
+    except IOError:
+        pass
+
+    pool.close()
+
+    async def async_tests():
+        apool = AsyncHTTPSPool(max_response_bytes=64)
+        for i in range(0, 3):
+            resp = await apool(url, data=b'hello %d' % i)
+            assert(json.load(resp) == {'echo': 'hello %d' % i})
+        assert(apool.connects == 1)
+
+        await apool(url, data=b'bye')
+        await asyncio.sleep(0.1)
+        assert(json.load(await apool(url, data=b'again')) == {'echo': 'again'})
+        assert(apool.connects == 2)
+
+        results = await asyncio.gather(*[
+            apool(url, data=b'%d' % i) for i in range(0, 4)])
+        assert([json.load(r)['echo'] for r in results] == ['0', '1', '2', '3'])
+        try:
+            await apool(url, data=b'x' * 100)
+            assert(not 'reached')
+        except IOError:
+            pass
+        apool.close()
+
+    asyncio.run(async_tests())
+    httpd.shutdown()
+    print('ok')
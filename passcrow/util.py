@@ -1,5 +1,6 @@
 import base64
 import json
+import operator
 import os
 import zlib
 
@@ -53,6 +54,8 @@ def pmkdir(path, mode):
 
 
 def _json_object_prop(name):
+    # Note: _json_object subclasses get faster accessors generated from
+    #       their _KEYS automatically, this is only kept for compatibility.
     return (lambda s: s._dict[name], lambda s,v: s._setitem(name, v))
 
 
@@ -63,6 +66,8 @@ class _json_encoder(json.JSONEncoder):
         return super().encode(o)
 
     def default(self, o):
+        if hasattr(o, 'to_json'):
+            return o.to_json()
         if hasattr(o, '_dict'):
             return o._dict
         return super().default(o)
@@ -70,6 +75,7 @@ class _json_encoder(json.JSONEncoder):
 
 def _json_list(elem_type):
     class _jl(list):
+        _elem_type = elem_type
         def __init__(self, other):
             super().__init__()
             self.extend(other)
@@ -82,22 +88,152 @@ def _json_list(elem_type):
     return _jl
 
 
-class _json_object():
+def _json_value_checker(vtype, limit, max_str, max_list):
+    if isinstance(vtype, type) and issubclass(vtype, bool):
+        return lambda v: isinstance(v, bool)
+    if isinstance(vtype, type) and issubclass(vtype, str):
+        limit = limit or max_str
+        return lambda v: isinstance(v, str) and len(v) <= limit
+    if isinstance(vtype, type) and issubclass(vtype, int):
+        return lambda v: isinstance(v, (int, float)) and not isinstance(v, bool)
+    if hasattr(vtype, '_elem_type'):
+        limit = limit or max_list
+        elem_ok = _json_value_checker(vtype._elem_type, None, max_str, max_list)
+        return lambda v: (isinstance(v, list) and len(v) <= limit
+            and all(elem_ok(e) for e in v))
+    if hasattr(vtype, '_KEYS'):
+        check = _json_validator(vtype, max_str=max_str, max_list=max_list)
+        def _check_nested(v):
+            try:
+                check(v)
+                return True
+            except ValueError:
+                return False
+        return _check_nested
+    if vtype in (dict, list):
+        return lambda v: isinstance(v, vtype)
+    return lambda v: True
+
+
+def _json_validator(obj_type, max_str=4096, max_list=16):
+    """
+    Compile a function which checks, in a single pass over a parsed JSON
+    dict, that it is plausible input for `obj_type.from_json()`: no
+    unknown keys, the right JSON types, and no oversized strings or lists.
+    Per-field limits can be given in the class's _LIMITS table.
+
+    This is much cheaper than constructing an object, so hostile or
+    malformed input can be rejected early. The check function raises a
+    ValueError if the data is unacceptable.
+    """
+    limits = getattr(obj_type, '_LIMITS', {})
+    checks = {}
+    for key, vtype in obj_type._KEYS.items():
+        checks[key] = checks[key.replace('-', '_')] = _json_value_checker(
+            vtype, limits.get(key), max_str, max_list)
+
+    def check(data):
+        if not isinstance(data, dict):
+            raise ValueError('Expected a JSON object')
+        for k, v in data.items():
+            ok = checks.get(k)
+            if ok is None:
+                raise ValueError('Invalid key: %s' % k)
+            if not ok(v):
+                raise ValueError('Invalid value for %s' % k)
+        return data
+
+    return check
+
+
+def _json_field_setter(slot, validator):
+    code = (
+        'def setter(self, value):\n'
+        '    if self._frozen is not None:\n'
+        '        self._frozen = None\n'
+        '    self.%s = validator(value)\n') % slot
+    namespace = {'validator': validator}
+    exec(code, namespace)
+    return namespace['setter']
+
+
+def _json_to_json(fields):
+    lines = ['def to_json(self):', '    d = {}']
+    for key, slot in fields:
+        lines.extend([
+            '    try:',
+            '        d[%r] = self.%s' % (key, slot),
+            '    except AttributeError:',
+            '        pass'])
+    lines.append('    return d')
+    namespace = {}
+    exec('\n'.join(lines), namespace)
+    return namespace['to_json']
+
+
+class _json_object_type(type):
+    """
+    This metaclass compiles the _KEYS of a _json_object into a record
+    class: each field is stored in a __slots__ slot, with a generated
+    property which reads the slot directly and validates on write. A
+    lookup table of per-field setters (accepting both dashed and
+    underscored names) and a to_json() method are generated as well.
+    """
+    def __new__(mcs, name, bases, ns):
+        fields = {}
+        for base in bases:
+            fields.update(getattr(base, '_SLOTS', {}))
+
+        slots = list(ns.get('__slots__', ()))
+        keys = ns.get('_KEYS')
+        if keys is not None:
+            for key in keys:
+                if key in fields:
+                    continue
+                attr = key.replace('-', '_')
+                fields[key] = '_f_' + attr
+                slots.append(fields[key])
+        ns['__slots__'] = tuple(slots)
+        ns['_SLOTS'] = fields
+
+        cls = super().__new__(mcs, name, bases, ns)
+        if keys is not None:
+            setters = {}
+            for key, validator in cls._KEYS.items():
+                slot = fields[key]
+                setter = _json_field_setter(slot, validator)
+                setters[key] = setters[key.replace('-', '_')] = setter
+                setattr(cls, key.replace('-', '_'),
+                    property(operator.attrgetter(slot), setter))
+            cls._SETTERS = setters
+            cls.to_json = _json_to_json(list(fields.items()))
+        return cls
+
+
+class _json_object(metaclass=_json_object_type):
+    __slots__ = ('_frozen',)
     _KEYS = {}
 
     def __init__(self, *others, **keyword_values):
-        self._dict = {}
-
-        # This is a naughty hack to avoid polluting our pydoc output
-        # with trivial methods.
-        self.items = self._dict.items
-
+        self._frozen = None
         if others or keyword_values:
             self.update(*others, **keyword_values)
             self._check_self()
         else:
             self._set_defaults()
 
+    @classmethod
+    def from_json(cls, data):
+        """Construct and check an object from a parsed JSON dict."""
+        self = cls.__new__(cls)
+        self._blank()
+        self._update(data)
+        self._check_self()
+        return self
+
+    def _blank(self):
+        self._frozen = None
+
     def update(self, *others, **keyword_values):
         for o in others:
             self._update(o)
@@ -105,8 +241,14 @@ class _json_object():
             self._update(keyword_values)
         return self
 
+    def items(self):
+        return self.to_json().items()
+
+    _dict = property(lambda s: s.to_json())
+
     def __contains__(self, key):
-        return (key in self._KEYS and self._dict.__contains__(key))
+        slot = self._SLOTS.get(key)
+        return (slot is not None) and hasattr(self, slot)
 
     def _check_self(self):
         pass
@@ -121,12 +263,31 @@ class _json_object():
 
     def _update(self, other):
         """Copy all key/value pairs from `other` into this object."""
+        setters = self._SETTERS
         for k, v in other.items():
-            self._setitem(k.replace('_', '-'), v)
+            try:
+                setter = setters[k]
+            except KeyError:
+                raise KeyError("Invalid key: %s" % k)
+            setter(self, v)
         return self
 
     def _setitem(self, key, value):
-        self._dict[key] = self._validate(key, value)
+        try:
+            setter = self._SETTERS[key]
+        except KeyError:
+            raise KeyError("Invalid key: %s" % key)
+        setter(self, value)
+
+    def freeze(self):
+        """
+        Pre-encode the compact wire representation of this object, so it
+        can be sent repeatedly without re-encoding. Only freeze objects
+        which will not be modified again.
+        """
+        self._frozen = None
+        self._frozen = bytes(self)
+        return self
 
     def __json__(self):
         return str(self)
@@ -134,14 +295,30 @@ class _json_object():
     def __repr__(self):
         return '<%s=%s>' % (type(self).__name__, self)
 
+    def __bytes__(self):
+        """The compact (wire format) JSON representation, as bytes."""
+        if self._frozen is not None:
+            return self._frozen
+        return bytes(
+            json.dumps(self.to_json(),
+                separators=(',', ':'), cls=_json_encoder),
+            'utf-8')
+
     def __str__(self):
-        return json.dumps(self._dict, indent=2, cls=_json_encoder)
+        """The human readable (indented) JSON representation."""
+        return json.dumps(self.to_json(), indent=2, cls=_json_encoder)
 
 
 class _encrypted_json_object(_json_object):
-    def __init__(self, *args, **kwargs):
+    __slots__ = ('encrypted_data', 'encryption_key')
+
+    def _blank(self):
+        self._frozen = None
         self.encrypted_data = None
         self.encryption_key = None
+
+    def __init__(self, *args, **kwargs):
+        self._blank()
         if len(args) == 1 and isinstance(args[0], str):
             self.encrypted_data = args[0]
             super().__init__(self, **kwargs)
@@ -150,7 +327,7 @@ class _encrypted_json_object(_json_object):
 
     def encrypt(self, key, compress=False):
         iv = random_bytes(16)  # == 128 bits
-        ed = bytes(str(self), 'utf-8')
+        ed = super().__bytes__()
         if compress:
             ed = zlib.compress(ed, 9)
         ed = aesgcm_encrypt(key, iv, ed)
@@ -159,7 +336,7 @@ class _encrypted_json_object(_json_object):
         return self
 
     def decrypt(self, key, decompress=False):
-        ed = base64.b64decode(self.encrypted_data)
+        ed = memoryview(base64.b64decode(self.encrypted_data))
         ed = aesgcm_decrypt(key, ed[:16], ed[16:])
         if decompress:
             ed = zlib.decompress(ed)
@@ -168,6 +345,11 @@ class _encrypted_json_object(_json_object):
         self.encryption_key = None
         return self
 
+    def __bytes__(self):
+        if self.encrypted_data is not None:
+            return bytes(self.encrypted_data, 'utf-8')
+        return super().__bytes__()
+
     def __str__(self):
         if self.encrypted_data is not None:
             return self.encrypted_data
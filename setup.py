@@ -14,7 +14,8 @@ from passcrow import VERSION
 
 setup(
   name = 'passcrow',
-  packages = ['passcrow', 'passcrow.handlers', 'passcrow.integration'],
+  packages = ['passcrow', 'passcrow.bench', 'passcrow.handlers',
+              'passcrow.integration'],
   entry_points = {'console_scripts': ['passcrow=passcrow.__main__:main']},
   version = VERSION,
   license='LGPL-3.0',